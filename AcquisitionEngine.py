@@ -0,0 +1,165 @@
+"""
+This code polls every data source concurrently on a small thread pool
+Each source runs on its own schedule and its results are merged into a single queue
+that the display loop drains, so a slow feed never stalls the others or the screen
+Failed polls back off per source and a circuit breaker rests feeds that stay down
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Scheduler resolution, how often due sources are checked
+SCHEDULER_TICK_S = 0.1
+
+# Retry backoff after a failed poll, grows per consecutive failure
+RETRY_BASE_MS = 2000
+RETRY_MAX_MS = 10000
+
+# Consecutive failures before a source is considered down, and how long to leave it alone
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_MS = 300000
+
+# Return system millisecond count
+def millis():
+	return int(round(time.time() * 1000))
+
+# Raised by a fetch function when its feed could not be reached or decoded
+class SourceUnavailable(Exception):
+	pass
+
+class CircuitBreaker:
+
+	# Class Constructor
+	def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, cooldownMs=CIRCUIT_COOLDOWN_MS):
+		self.threshold = threshold
+		self.cooldownMs = cooldownMs
+		self.failures = 0
+		self.openUntil = 0
+
+	def isOpen(self, now=None):
+		if now is None:
+			now = millis()
+		return now < self.openUntil
+
+	def recordSuccess(self):
+		self.failures = 0
+		self.openUntil = 0
+
+	# Record a failed poll and return how many ms to wait before the next attempt
+	def recordFailure(self, now=None):
+		if now is None:
+			now = millis()
+		self.failures += 1
+		if self.failures >= self.threshold:
+			# Open the circuit, the next poll after the cooldown is a single probe
+			self.openUntil = now + self.cooldownMs
+			self.failures = self.threshold - 1
+			return self.cooldownMs
+		return min(RETRY_BASE_MS * self.failures, RETRY_MAX_MS)
+
+class AcquisitionEngine:
+
+	# Class Constructor
+	def __init__(self):
+		# name -> source state
+		self.sources = {}
+		self.results = queue.Queue()
+		self.lock = threading.Lock()
+		self.stopEvent = threading.Event()
+		self.executor = None
+		self.thread = None
+
+	# Register a source, fetch() runs on a worker thread and its return value is queued
+	# fetch() returns None or raises SourceUnavailable when the feed could not be polled
+	def addSource(self, name, fetch, intervalMs):
+		with self.lock:
+			self.sources[name] = {
+				'fetch': fetch,
+				'interval': intervalMs,
+				'nextPoll': 0,
+				'busy': False,
+				'breaker': CircuitBreaker(),
+			}
+
+	def removeSource(self, name):
+		with self.lock:
+			self.sources.pop(name, None)
+
+	# Start polling all registered sources
+	def start(self):
+		if self.thread is not None:
+			return False
+		self.stopEvent.clear()
+		self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.sources)), thread_name_prefix='EQAcquire')
+		self.thread = threading.Thread(target=self._schedule, name='EQScheduler', daemon=True)
+		self.thread.start()
+		return True
+
+	def stop(self):
+		if self.thread is None:
+			return False
+		self.stopEvent.set()
+		self.thread.join()
+		self.thread = None
+		self.executor.shutdown(wait=False)
+		self.executor = None
+		return True
+
+	# Submit every source that is due and not already being fetched
+	def _schedule(self):
+		while not self.stopEvent.is_set():
+			now = millis()
+			with self.lock:
+				for name, source in self.sources.items():
+					if source['busy'] or now < source['nextPoll']:
+						continue
+					source['busy'] = True
+					self.executor.submit(self._poll, name, source)
+			self.stopEvent.wait(SCHEDULER_TICK_S)
+
+	def _poll(self, name, source):
+		breaker = source['breaker']
+		try:
+			result = source['fetch']()
+		except SourceUnavailable:
+			result = None
+		except Exception as e:
+			print("Error polling " + name + ":", e)
+			result = None
+
+		# Queue before scheduling so results from one source stay in order
+		if result is not None:
+			self.results.put((name, result))
+
+		with self.lock:
+			now = millis()
+			if result is None:
+				# Failed polls are retried with backoff instead of sleeping in the worker
+				delay = breaker.recordFailure(now)
+				if breaker.isOpen(now):
+					print("Source " + name + " is down, next try in " + str(delay // 1000) + "s")
+				source['nextPoll'] = now + delay
+			else:
+				breaker.recordSuccess()
+				source['nextPoll'] = now + source['interval']
+			source['busy'] = False
+
+	# True if the source has failed enough to stop polling it for a while
+	def isSourceDown(self, name):
+		with self.lock:
+			source = self.sources.get(name)
+			return source is not None and source['breaker'].isOpen()
+
+	# Return all queued (name, result) pairs without blocking
+	def drain(self):
+		results = []
+		while not self.results.empty():
+			try:
+				results.append(self.results.get_nowait())
+			except queue.Empty:
+				break
+		return results
+
+# Return a class instance
+acquisitionEngine = AcquisitionEngine()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+This code reads and writes the binary daily database files
+A day file is a fixed header (count, min/max origin time, largest magnitude, top region),
+then one fixed size record per event, newest first, then a table of the interned values
+(ids, alerts, tsunami flags, locations) as JSON. Files are mmap'ed, so reading one fact
+or one record never deserializes the rest, and nothing is unpickled.
+
+Old pickled day files are never loaded, convert the ones you trust in place with:
+
+	python3 DayFile.py EQMdatabase*.dat
+"""
+from collections import Counter
+import json
+import math
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+MAGIC = b'EQMD'
+VERSION = 1
+# magic, version, record size, count, min time, max time, max mag, top region, value count, value table offset
+HEADER = struct.Struct('<4sHHIdddiIQ')
+# lon, lat, mag, depth, origin time (epoch s), then value table indexes of id, alert, tsunami, location
+RECORD = struct.Struct('<dddddiiii')
+# Length prefix of each value table entry
+VALUE_LENGTH = struct.Struct('<I')
+
+NAN = float('nan')
+
+# Read-only view of one day file
+class DayFile:
+
+	# Class Constructor, takes a path or an open binary file
+	# Raises ValueError for a file that is not a whole day file, closing what it opened
+	def __init__(self, source):
+		self.file = open(source, "rb") if isinstance(source, (str, bytes, os.PathLike)) else source
+		self.ownsFile = self.file is not source
+		self.map = None
+		try:
+			size = os.fstat(self.file.fileno()).st_size
+			if size < HEADER.size:
+				raise ValueError("truncated day file, " + str(size) + " bytes")
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+			self._readHeader()
+		except BaseException:
+			self.close()
+			raise
+
+	def _readHeader(self):
+		(magic, version, recordSize, self.count, minTime, maxTime, maxMag, topRegion,
+			valueCount, valueOffset) = HEADER.unpack_from(self.map, 0)
+		if magic != MAGIC:
+			raise ValueError("not an EQMap day file")
+		if version != VERSION or recordSize != RECORD.size:
+			raise ValueError("unsupported day file version " + str(version))
+		if valueOffset < HEADER.size + self.count * RECORD.size or valueOffset > len(self.map):
+			raise ValueError("truncated day file, records end past the data")
+		self.minTime = optional(minTime)
+		self.maxTime = optional(maxTime)
+		self.maxMag = optional(maxMag)
+		self.values = []
+		offset = valueOffset
+		for i in range(valueCount):
+			if offset + VALUE_LENGTH.size > len(self.map):
+				raise ValueError("truncated day file, value table ends past the data")
+			(length,) = VALUE_LENGTH.unpack_from(self.map, offset)
+			offset += VALUE_LENGTH.size
+			if offset + length > len(self.map):
+				raise ValueError("truncated day file, value table ends past the data")
+			# A corrupt entry raises ValueError from the decode
+			self.values.append(json.loads(bytes(self.map[offset:offset + length]).decode('utf-8')))
+			offset += length
+		self.topRegion = self.values[topRegion] if 0 <= topRegion < valueCount else None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+		if self.ownsFile:
+			self.file.close()
+
+	def __len__(self):
+		return self.count
+
+	def _record(self, index):
+		if index < 0:
+			index += self.count
+		if index < 0 or index >= self.count:
+			raise IndexError("event index out of range")
+		return RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+
+	# The same 6-tuple the event queue holds
+	def __getitem__(self, index):
+		lon, lat, mag, depth, eventTime, eventID, alert, tsunami, location = self._record(index)
+		return (lon, lat, mag, self.values[alert], self.values[tsunami], self.values[location])
+
+	def __iter__(self):
+		for index in range(self.count):
+			yield self[index]
+
+	# (source event id, origin time) of each event, in queue order, for EventDB.EQEventMeta
+	def meta(self):
+		result = []
+		for index in range(self.count):
+			record = self._record(index)
+			result.append((self.values[record[5]], optional(record[4])))
+		return result
+
+	# Depth of each event in km or None, in queue order
+	def depths(self):
+		return [optional(self._record(index)[3]) for index in range(self.count)]
+
+# Header summary of a day file, or None if it is not one
+def readHeader(path):
+	try:
+		with DayFile(path) as day:
+			return {'count': day.count, 'minTime': day.minTime, 'maxTime': day.maxTime,
+				'maxMag': day.maxMag, 'topRegion': day.topRegion}
+	except (OSError, ValueError, struct.error):
+		return None
+
+# Error for a file that is not a day file, e.g. one in the old pickled format
+def notDayFileError(path):
+	return ValueError(str(path) + " is not an EQMap day file, if it is an old pickled one you trust convert it with: "
+		"python3 DayFile.py " + str(path))
+
+# True if the open binary file starts with the day file magic, leaves it at the start
+def isDayFile(dbFile):
+	magic = dbFile.read(len(MAGIC))
+	dbFile.seek(0)
+	return magic == MAGIC
+
+# Write events (newest first 6-tuples) with optional (id, time) meta and depths to an open binary file
+def writeDayFile(dbFile, events, meta=None, depths=None):
+	values = []
+	valueIndex = {}
+
+	def intern(value):
+		key = json.dumps(value)
+		index = valueIndex.get(key)
+		if index is None:
+			index = len(values)
+			values.append(key.encode('utf-8'))
+			valueIndex[key] = index
+		return index
+
+	records = []
+	minTime = maxTime = maxMag = None
+	locations = Counter()
+	for position, event in enumerate(events):
+		lon, lat, mag, alert, tsunami, location = event
+		eventID, eventTime = meta[position] if meta is not None else (None, None)
+		depth = depths[position] if depths is not None else None
+		if eventTime is not None:
+			minTime = eventTime if minTime is None else min(minTime, eventTime)
+			maxTime = eventTime if maxTime is None else max(maxTime, eventTime)
+		magValue = toFloat(mag)
+		if not math.isnan(magValue) and (maxMag is None or magValue > maxMag):
+			maxMag = magValue
+		locations[location] += 1
+		records.append(RECORD.pack(toFloat(lon), toFloat(lat), magValue, toFloat(depth), toFloat(eventTime),
+			intern(eventID), intern(alert), intern(tsunami), intern(location)))
+
+	common = locations.most_common(1)
+	topRegion = intern(common[0][0]) if common else -1
+	valueOffset = HEADER.size + len(records) * RECORD.size
+	dbFile.write(HEADER.pack(MAGIC, VERSION, RECORD.size, len(records), toFloat(minTime), toFloat(maxTime),
+		toFloat(maxMag), topRegion, len(values), valueOffset))
+	dbFile.write(b''.join(records))
+	for value in values:
+		dbFile.write(VALUE_LENGTH.pack(len(value)))
+		dbFile.write(value)
+	return len(records)
+
+# Rewrite a pickled day file (or .demo file) in the binary format, in place
+# This unpickles the file, which can run code, so it is only done when asked for
+# Returns False if it already was one
+def convert(path):
+	with open(path, "rb") as dbFile:
+		if isDayFile(dbFile):
+			return False
+		events = list(pickle.load(dbFile))
+	tempName = path + ".tmp"
+	with open(tempName, "wb") as dbFile:
+		writeDayFile(dbFile, events)
+	os.replace(tempName, path)
+	return True
+
+def toFloat(value):
+	try:
+		return float(value)
+	except (ValueError, TypeError):
+		return NAN
+
+def optional(value):
+	return None if math.isnan(value) else value
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2:
+		print("usage: DayFile.py file.dat [file.demo ...]")
+		sys.exit(1)
+	for name in sys.argv[1:]:
+		try:
+			print(name, "converted" if convert(name) else "already binary")
+		except Exception as e:
+			print(name, "failed:", e)
@@ -0,0 +1,103 @@
+"""
+This code keeps a small sidecar index of per-day summaries for the saved daily database files
+Count, largest magnitude and most active region come from the day file's header and are
+checked against its mtime, so the 7-day trend never reads whole days again. Old pickled
+files are skipped, not unpickled.
+Directory listings are cached against the directory mtime for the same reason.
+"""
+import glob
+import json
+import os
+from DayFile import readHeader, notDayFileError
+
+INDEX_FILE_NAME = "EQMdayindex.json"
+
+class DayIndex:
+
+	# Class Constructor
+	def __init__(self):
+		# day file path -> {'stamp': [mtime_ns, size], 'count', 'maxMag', 'topRegion'}
+		self.entries = {}
+		# Directories whose sidecar has been read
+		self.loadedDirs = set()
+		# glob pattern -> (directory mtime_ns, sorted file names)
+		self.listings = {}
+		# Files that are not day files, reported once
+		self.rejected = set()
+
+	# Sorted day files matching the pattern, re-globbed only when the directory changes
+	def files(self, pattern):
+		directory = os.path.dirname(pattern) or "."
+		try:
+			dirStamp = os.stat(directory).st_mtime_ns
+		except OSError:
+			return []
+		listing = self.listings.get(pattern)
+		if listing is None or listing[0] != dirStamp:
+			listing = (dirStamp, sorted(glob.glob(pattern)))
+			self.listings[pattern] = listing
+		return listing[1]
+
+	# Summary of one day file, rebuilt from the file only if it changed since it was indexed
+	def get(self, path):
+		try:
+			stamp = fileStamp(path)
+		except OSError:
+			return None
+		self._loadSidecar(path)
+		entry = self.entries.get(path)
+		if entry is not None and entry['stamp'] == stamp:
+			return entry
+		# Day files carry their summary in the header
+		header = readHeader(path)
+		if header is None:
+			# Skip old pickled, unreadable or corrupt history files
+			if path not in self.rejected:
+				self.rejected.add(path)
+				print("DayIndex:", notDayFileError(path))
+			return None
+		return self._store(path, stamp, (header['count'], header['maxMag'], header['topRegion']))
+
+	def _store(self, path, stamp, summary):
+		count, maxMag, topRegion = summary
+		entry = {'stamp': stamp, 'count': count, 'maxMag': maxMag, 'topRegion': topRegion}
+		self.entries[path] = entry
+		self._writeSidecar(os.path.dirname(path) or ".")
+		return entry
+
+	def _loadSidecar(self, path):
+		directory = os.path.dirname(path) or "."
+		if directory in self.loadedDirs:
+			return
+		self.loadedDirs.add(directory)
+		try:
+			with open(os.path.join(directory, INDEX_FILE_NAME), "r") as indexFile:
+				saved = json.load(indexFile)
+		except (OSError, ValueError):
+			return
+		if not isinstance(saved, dict):
+			return
+		for name, entry in saved.items():
+			try:
+				entry['stamp'] = list(entry['stamp'])
+			except (KeyError, TypeError):
+				continue
+			self.entries.setdefault(os.path.join(directory, name) if directory != "." else name, entry)
+
+	# Rewrite the directory's sidecar, entries keyed by file name
+	def _writeSidecar(self, directory):
+		saved = {}
+		for path, entry in self.entries.items():
+			if (os.path.dirname(path) or ".") == directory:
+				saved[os.path.basename(path)] = entry
+		indexName = os.path.join(directory, INDEX_FILE_NAME)
+		try:
+			with open(indexName + ".tmp", "w") as indexFile:
+				json.dump(saved, indexFile)
+			os.replace(indexName + ".tmp", indexName)
+		except OSError:
+			pass
+
+def fileStamp(path):
+	status = os.stat(path)
+	return [status.st_mtime_ns, status.st_size]
@@ -4,20 +4,50 @@ Concept, Design by: Craig A. Lindley
 """
 
 import os, time, sys
+from collections import OrderedDict
 from datetime import datetime
 
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide" # hide pygame prompt message
 import pygame, pygame.freetype
 
+FONT_FILE = 'fonts/Sony.ttf'
+# Rendered text surfaces kept for reuse, least recently drawn dropped first
+TEXT_CACHE_SIZE = 256
+# Largest marker radius in pixels, a magnitude 10 event
+MARKER_RADIUS_MAX = 30
+
 class DisplayManager:
 
 	# Class constructor
 	def __init__(self):
 		self.hasGUI = False
 		self.screen = None
+		# Surface the draw calls paint on, the screen unless a layer is being drawn
+		self.target = None
+		# Offscreen map plus plotted events, and a transparent text overlay, composited to the screen
+		self.baseLayer = None
+		self.overlayLayer = None
+		self.layersStale = True
+		# Areas the overlay drew, the ones it drew last frame, areas plotted on the base layer
+		# and areas drawn straight on the screen, so composite() only copies what changed
+		self.overlayRects = []
+		self.staleOverlayRects = []
+		self.baseRects = []
+		self.screenRects = []
+		self.fullComposite = True
+		# Cleared base layer area being redrawn, already noted as changed
+		self.redrawingArea = None
+		# Areas of the screen drawn since the last present
+		self.dirtyRects = []
+		# Markers that blink as (lon, lat, mag), and the screen patches under them while blanked
+		self.blinkMarkers = []
+		self.blinkPatches = []
 		self.mapImageRect = None
 		self._batchMode = False
+		self.font = None
 		self.fontSize = 40
+		# (text, size, color) -> (surface, rect)
+		self.textCache = OrderedDict()
 		self.dist = "m" # or k miles/kilo
 		self.time24h = False
 		self.firstRun = True
@@ -46,6 +76,7 @@ class DisplayManager:
 			# Set the display mode to fullscreen
 			#set monitor to use
 			self.screen = pygame.display.set_mode((0,0), pygame.FULLSCREEN)
+			self.target = self.screen
 			self.displayInfo = pygame.display.Info()
 			self.screenWidth  = self.displayInfo.current_w
 			self.screenHeight = self.displayInfo.current_h
@@ -56,6 +87,8 @@ class DisplayManager:
 			self.mapImage = pygame.image.load('maps/eqm800_shaded.bmp')
 			if self.screenWidth > 1000:
 				self.mapImage = pygame.transform.scale(self.mapImage, (1024, 516))
+			# In the screen's pixel format so blits need no conversion
+			self.mapImage = self.mapImage.convert()
 
 			# Get its bounding box
 			self.mapImageRect = self.mapImage.get_rect()
@@ -69,8 +102,8 @@ class DisplayManager:
 			self.bottomTextRow = (self.mapImageRect.y + self.mapImageRect.height) + 5
 			self.eventsTextRow = self.bottomTextRow - 30
 
-			# Setup inital font of initial size
-			self.font = pygame.freetype.Font('fonts/Sony.ttf', self.fontSize) #legacy pygame > v2.0
+			# Load the font face once, setTextSize() only changes the size it renders at
+			self.font = pygame.freetype.Font(FONT_FILE, self.fontSize) #legacy pygame > v2.0
 			#self.font = pygame.font.SysFont('arial',self.fontSize)
 			self.hasGUI = True
 		
@@ -79,6 +112,7 @@ class DisplayManager:
 			self.screenWidth = -1
 			self.screenHeight = -1
 			self.screen = None
+			self.target = None
 			self.mapImageRect = None
 			self.hasGUI = False
 
@@ -90,17 +124,170 @@ class DisplayManager:
 	def endFrame(self):
 		if self.hasGUI:
 			self._batchMode = False
-			pygame.display.flip()
+			self._present()
 
+	# Note an area drawn on the screen, drawing on a layer reaches the screen through composite()
+	# Once the whole screen is dirty, later areas inside it are not kept
+	def _markDirty(self, rect):
+		if rect is None:
+			return rect
+		rect = pygame.Rect(rect)
+		if self.target is self.overlayLayer:
+			self.overlayRects.append(rect)
+			return rect
+		if self.target is self.baseLayer:
+			if self.redrawingArea is None:
+				self.baseRects.append(rect)
+			return rect
+		if self.target is not self.screen:
+			return rect
+		# Blinking draws the same areas over and over, keep each once
+		if self.baseLayer is not None and rect not in self.screenRects:
+			self.screenRects.append(rect)
+		if self.dirtyRects and self.dirtyRects[0].contains(rect):
+			return rect
+		if rect.contains(self.screen.get_rect()):
+			self.dirtyRects = [rect]
+		else:
+			self.dirtyRects.append(rect)
+		return rect
+
+	# Update only the areas drawn since the last present instead of flipping the whole screen
 	def _present(self):
-		if self.hasGUI and not self._batchMode:
-			pygame.display.flip()
+		if self.hasGUI and not self._batchMode and self.target is self.screen and self.dirtyRects:
+			pygame.display.update(self.dirtyRects)
+			self.dirtyRects = []
+
+	# True if the base layer holds the current map and screen size
+	def hasBaseLayer(self):
+		return self.baseLayer is not None and not self.layersStale
+
+	# Start the base layer over from the bare map
+	def resetBaseLayer(self):
+		if not self.hasGUI or self.screen is None or self.mapImageRect is None:
+			return False
+		size = self.screen.get_size()
+		if self.baseLayer is None or self.baseLayer.get_size() != size:
+			self.baseLayer = pygame.Surface(size).convert()
+			self.overlayLayer = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+		self.baseLayer.fill(self.black)
+		self.baseLayer.blit(self.mapImage, self.mapImageRect)
+		self.overlayLayer.fill((0, 0, 0, 0))
+		self.overlayRects = []
+		self.fullComposite = True
+		self.layersStale = False
+		return True
+
+	# Send draw calls to the base layer until endLayer(), e.g. to plot new events
+	def beginBaseLayer(self):
+		if self.hasBaseLayer():
+			self.target = self.baseLayer
+
+	# Put the bare map back under the markers of events that are gone, on the base layer
+	# Returns the cleared areas, overlapping ones merged, for redrawArea() to draw the remaining events in
+	def eraseMarkers(self, markers):
+		areas = []
+		if not self.hasBaseLayer() or self.target is not self.baseLayer:
+			return areas
+		bounds = self.baseLayer.get_rect()
+		for lon, lat, mag in markers:
+			try:
+				mapX, mapY, radius = self.markerCircle(lon, lat, float(mag))
+			except (ValueError, TypeError):
+				continue
+			size = int(radius) * 2 + 4
+			rect = pygame.Rect(int(mapX) - size // 2, int(mapY) - size // 2, size, size).clip(bounds)
+			if rect.width <= 0 or rect.height <= 0:
+				continue
+			self.baseLayer.fill(self.black, rect)
+			self.baseLayer.blit(self.mapImage, rect.topleft, rect.move(-self.mapImageRect.x, -self.mapImageRect.y))
+			self._markDirty(rect)
+			# A swarm evicts markers on top of each other, redraw each patch of them once
+			merged = True
+			while merged:
+				merged = False
+				for area in areas:
+					if area.colliderect(rect):
+						areas.remove(area)
+						rect.union_ip(area)
+						merged = True
+						break
+			areas.append(rect)
+		return areas
+
+	# Limit drawing to a cleared area until endRedraw(), redrawing every event that reaches into it
+	# in the order they were plotted leaves it as a full redraw would
+	# Returns the (minLon, minLat, maxLon, maxLat) box holding those events, markers are at most largestMag big
+	def redrawArea(self, area, largestMag=None):
+		self.baseLayer.set_clip(area)
+		self.redrawingArea = area
+		try:
+			radius = min(MARKER_RADIUS_MAX, int(self.markerCircle(0, 0, float(largestMag))[2]) + 2)
+		except (ValueError, TypeError):
+			radius = MARKER_RADIUS_MAX
+		reach = area.inflate(2 * radius, 2 * radius)
+		minLon = (reach.left - self.mapImageRect.x) * 360.0 / self.mapImageRect.width - 180.0
+		maxLon = (reach.right - self.mapImageRect.x) * 360.0 / self.mapImageRect.width - 180.0
+		maxLat = 90.0 - (reach.top - self.mapImageRect.y) * 180.0 / self.mapImageRect.height
+		minLat = 90.0 - (reach.bottom - self.mapImageRect.y) * 180.0 / self.mapImageRect.height
+		return (max(-180.0, minLon), max(-90.0, minLat), min(180.0, maxLon), min(90.0, maxLat))
+
+	# True if an event's marker reaches into the area being redrawn
+	def markerReaches(self, lon, lat, mag):
+		try:
+			mapX, mapY, radius = self.markerCircle(lon, lat, float(mag))
+		except (ValueError, TypeError):
+			return False
+		area = self.redrawingArea
+		return (area is not None and area.left - radius - 2 <= mapX <= area.right + radius + 2 and
+			area.top - radius - 2 <= mapY <= area.bottom + radius + 2)
+
+	def endRedraw(self):
+		self.redrawingArea = None
+		if self.baseLayer is not None:
+			self.baseLayer.set_clip(None)
+
+	# Send draw calls to a cleared overlay until endLayer(), for text and markers
+	# Only what the last overlay drew is cleared, not the whole surface
+	def beginOverlay(self):
+		if self.hasBaseLayer():
+			for rect in self.overlayRects:
+				self.overlayLayer.fill((0, 0, 0, 0), rect)
+			self.staleOverlayRects.extend(self.overlayRects)
+			self.overlayRects = []
+			self.target = self.overlayLayer
+
+	def endLayer(self):
+		self.target = self.screen
+
+	# Put the base layer with the overlay on top on the screen
+	# After a reset the whole base layer is copied, otherwise only the areas that changed
+	def composite(self):
+		if not self.hasBaseLayer():
+			return False
+		if self.fullComposite:
+			self._markDirty(self.screen.blit(self.baseLayer, (0, 0)))
+		else:
+			for rect in self.staleOverlayRects + self.baseRects + self.screenRects + self.overlayRects:
+				self._markDirty(self.screen.blit(self.baseLayer, rect, rect))
+		for rect in self.overlayRects:
+			self.screen.blit(self.overlayLayer, rect, rect)
+		self.staleOverlayRects = []
+		self.baseRects = []
+		self.screenRects = []
+		self.fullComposite = False
+		# The repaint already took any blanked markers off the screen
+		self.blinkPatches = []
+		self._present()
+		return True
 
 	def clearScreen(self):
 		try:
 			if not self.hasGUI or self.screen is None:
 				return False
-			self.screen.fill(self.black)
+			if self.target is self.screen:
+				self.blinkPatches = []
+			self._markDirty(self.target.fill(self.black))
 			self._present()
 			return True
 		except:
@@ -147,19 +334,33 @@ class DisplayManager:
 			if not self.hasGUI or self.screen is None or self.mapImageRect is None:
 				return False
 			self.clearScreen()
-			self.screen.blit(self.mapImage, self.mapImageRect)
+			self._markDirty(self.target.blit(self.mapImage, self.mapImageRect))
 			self._present()
 			return True
 		except:
 			return False
 
+	# Rendered surface and size of text at the current size and color, from the cache if drawn before
+	def renderText(self, text):
+		key = (text, self.fontSize, self.textColor)
+		rendered = self.textCache.get(key)
+		if rendered is not None:
+			self.textCache.move_to_end(key)
+			return rendered
+		rendered = self.font.render(text, self.textColor)
+		self.textCache[key] = rendered
+		if len(self.textCache) > TEXT_CACHE_SIZE:
+			self.textCache.popitem(last=False)
+		return rendered
+
 	# Draw text
 	def drawText(self, x, y, text):
 		try:
 			if not self.hasGUI or self.screen is None:
 				print(text)
 				return False
-			self.font.render_to(self.screen, (x, y), text, self.textColor)
+			textSurface, rect = self.renderText(text)
+			self._markDirty(self.target.blit(textSurface, (x, y)))
 			self._present()
 			return True
 		except:
@@ -172,9 +373,9 @@ class DisplayManager:
 			if not self.hasGUI or self.screen is None:
 				print(text)
 				return False
-			textSurface, rect = self.font.render(text, self.textColor)
+			textSurface, rect = self.renderText(text)
 			x = (self.screenWidth - rect.width) / 2
-			self.font.render_to(self.screen, (x, y), text, self.textColor)
+			self._markDirty(self.target.blit(textSurface, (x, y)))
 			self._present()
 			return True
 		except:
@@ -187,9 +388,9 @@ class DisplayManager:
 			if not self.hasGUI or self.screen is None or self.mapImageRect is None:
 				print(text)
 				return False
-			textSurface, rect = self.font.render(text, self.textColor)
+			textSurface, rect = self.renderText(text)
 			x = (self.mapImageRect.x + self.mapImageRect.width) - rect.width - 2
-			self.font.render_to(self.screen, (x, y), text, self.textColor)
+			self._markDirty(self.target.blit(textSurface, (x, y)))
 			self._present()
 			return True
 		except:
@@ -199,8 +400,8 @@ class DisplayManager:
 	# Set text size
 	def setTextSize(self, size):
 		self.fontSize = size
-		self.font = pygame.freetype.Font('fonts/Sony.ttf', self.fontSize) #legacy pygame > v2.0
-		#self.font = pygame.font.SysFont('arial',self.fontSize)
+		if self.font is not None:
+			self.font.size = size
 
 	# Set text color
 	def setTextColor(self, color):
@@ -211,24 +412,28 @@ class DisplayManager:
 		try:
 			if not self.hasGUI or self.screen is None:
 				return False
-			pygame.draw.circle(self.screen, color, (int(x), int(y)), int(radius), 2)
+			self._markDirty(pygame.draw.circle(self.target, color, (int(x), int(y)), int(radius), 2))
 			self._present()
 			return True
 		except:
 			return False
 
+	# Screen position and radius of the circle for an event at lon, lat
+	def markerCircle(self, lon, lat, mag):
+		# Calculate map X and Y
+		mapX = ((float(lon) + 180.0) * self.mapImageRect.width) / 360.0 + self.mapImageRect.x
+		mapY = ((((-1 * float(lat)) + 90.0) * self.mapImageRect.height) / 180.0) + self.mapImageRect.y
+
+		if mag < 0.8: mag = 0.8 #too small to see blink
+
+		# Determine circle radius from mag
+		return mapX, mapY, mag * 3
+
 	# Draw a circle with size based on mag at lon, lat position on map
 	def mapEarthquake(self, lon, lat, mag, color):
 		
 		if self.hasGUI and self.mapImageRect is not None and lon != '':
-			# Calculate map X and Y
-			mapX = ((float(lon) + 180.0) * self.mapImageRect.width) / 360.0 + self.mapImageRect.x
-			mapY = ((((-1 * float(lat)) + 90.0) * self.mapImageRect.height) / 180.0) + self.mapImageRect.y
-			
-			if mag < 0.8: mag = 0.8 #too small to see blink
-			
-			# Determine circle radius from mag
-			radius = mag * 3
+			mapX, mapY, radius = self.markerCircle(lon, lat, mag)
 			# Draw a circle at earthquake location
 			self.drawCircle(mapX, mapY, radius, color)
 
@@ -237,6 +442,45 @@ class DisplayManager:
 			#CLI 
 			return False
 
+	# Set the markers to blink as (lon, lat, mag), putting back any that are blanked now
+	def setBlinkMarkers(self, markers):
+		self.restoreBlink()
+		self.blinkMarkers = list(markers)
+
+	# Blank the blinking markers, restoreBlink() puts back what was under them
+	def blink(self):
+		self.restoreBlink()
+		if not self.hasGUI or self.screen is None or self.mapImageRect is None or self.target is not self.screen:
+			return False
+		screenRect = self.screen.get_rect()
+		circles = []
+		for lon, lat, mag in self.blinkMarkers:
+			try:
+				mapX, mapY, radius = self.markerCircle(lon, lat, mag)
+			except (ValueError, TypeError):
+				continue
+			# Save every patch before blanking any, so overlapping markers restore cleanly
+			size = int(radius) * 2 + 4
+			patchRect = pygame.Rect(int(mapX) - size // 2, int(mapY) - size // 2, size, size).clip(screenRect)
+			if patchRect.width > 0 and patchRect.height > 0:
+				self.blinkPatches.append((patchRect.topleft, self.screen.subsurface(patchRect).copy()))
+				circles.append((mapX, mapY, radius))
+		for mapX, mapY, radius in circles:
+			self._markDirty(pygame.draw.circle(self.screen, self.black, (int(mapX), int(mapY)), int(radius), 2))
+		self._present()
+		return len(circles) > 0
+
+	# Put back the map and events under blanked markers
+	def restoreBlink(self):
+		if not self.blinkPatches or self.screen is None:
+			self.blinkPatches = []
+			return False
+		for position, patch in reversed(self.blinkPatches):
+			self._markDirty(self.screen.blit(patch, position))
+		self.blinkPatches = []
+		self._present()
+		return True
+
 	# pygames key press
 	def handleKeyPress(self):
 		if not self.hasGUI or self.screen is None or self.mapImageRect is None:
@@ -258,10 +502,16 @@ class DisplayManager:
 					sys.exit()
 				if event.key == pygame.K_f:
 					self.screen = pygame.display.set_mode((0,0), pygame.FULLSCREEN)
+					self.target = self.screen
+					self.layersStale = True
+					self.blinkPatches = []
 					return True
 				if event.key == pygame.K_w:
 					#window
 					self.screen = pygame.display.set_mode((800, 480))
+					self.target = self.screen
+					self.layersStale = True
+					self.blinkPatches = []
 					return True
 				if event.key == pygame.K_h:
 					# flip flop for time24h
@@ -292,7 +542,7 @@ class DisplayManager:
 				if event.key == pygame.K_m:
 					#change map
 					# Read the map into memory, center it and reset text boxes if sized changed
-					self.mapImage = pygame.image.load('maps/eqm800.bmp')
+					self.mapImage = pygame.image.load('maps/eqm800.bmp').convert()
 
 					self.mapImageRect = self.mapImage.get_rect()
 					self.mapImageRect.y = (pygame.display.get_surface().get_height() - self.mapImageRect.height) / 2
@@ -300,7 +550,9 @@ class DisplayManager:
 					self.topTextRow = self.mapImageRect.y - 25
 					self.eventsTextRow = self.topTextRow + 400
 					self.bottomTextRow = self.topTextRow + 430
-					self.screen.blit(self.mapImage, self.mapImageRect)
+					self.layersStale = True
+					self.blinkPatches = []
+					self._markDirty(self.screen.blit(self.mapImage, self.mapImageRect))
 					self._present()
 					return True
 				if event.key == pygame.K_u:
@@ -327,7 +579,7 @@ class DisplayManager:
 		try:
 			if not self.hasGUI or self.mapImageRect is None:
 				return timeNow
-			pygame.draw.rect(self.screen,self.black,(self.mapImageRect.x,self.topTextRow,130,25))
+			self._markDirty(pygame.draw.rect(self.target,self.black,(self.mapImageRect.x,self.topTextRow,130,25)))
 			self.setTextSize(40)
 			self.drawText(self.mapImageRect.x, self.topTextRow, timeString)
 		except Exception: 
@@ -396,8 +648,8 @@ class DisplayManager:
 				x = int(x0 + (i / (len(spark_vals) - 1)) * spark_w)
 				y = int(y0 + spark_h - (((val - min_val) / span) * spark_h))
 				if prev_x is not None:
-					pygame.draw.line(self.screen, trend_color, (prev_x, prev_y), (x, y), 2)
-				pygame.draw.circle(self.screen, trend_color, (x, y), 2)
+					self._markDirty(pygame.draw.line(self.target, trend_color, (prev_x, prev_y), (x, y), 2))
+				self._markDirty(pygame.draw.circle(self.target, trend_color, (x, y), 2))
 				prev_x = x
 				prev_y = y
 
@@ -470,7 +722,7 @@ class DisplayManager:
 					x = x0 + (i / (len(dayTrend) - 1)) * graph_width
 					y = y0 + graph_height - (val / max_val) * graph_height if max_val > 0 else y0 + graph_height
 					if prev_x is not None and prev_y is not None:
-						pygame.draw.line(self.screen, self.green, (prev_x, prev_y), (x, y), 2)
+						self._markDirty(pygame.draw.line(self.target, self.green, (prev_x, prev_y), (x, y), 2))
 					prev_x = x
 					prev_y = y
 
@@ -522,7 +774,7 @@ class DisplayManager:
 			mapY = ((((-1 * float(lat)) + 90.0) * self.mapImageRect.height) / 180.0) + self.mapImageRect.y
 			
 			# Draw a triangle at volcano location
-			pygame.draw.polygon(self.screen, self.red, [(mapX, mapY - 6), (mapX - 5, mapY + 4), (mapX + 5, mapY + 4)], 0)
+			self._markDirty(pygame.draw.polygon(self.target, self.red, [(mapX, mapY - 6), (mapX - 5, mapY + 4), (mapX + 5, mapY + 4)], 0))
 			self._present()
 			return mapX, mapY, self.blue
 		else:
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Feed replay server and ingestion benchmark
+Serves synthetic or recorded events as a USGS style GeoJSON feed and a seismicportal style
+FDSN query service on localhost, with bursts, 304s, timeouts and malformed bodies, then drives
+EQEventGatherer -> EventDB.addEvent -> repaintMap against it and reports events/sec and
+end-to-end latency
+
+	python3 EQBench.py --duration 60 --rate 5 --burst-every 10 --burst-size 200 --headless
+	python3 EQBench.py --recorded all_day.geojson --speed 600
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Feed window served by the USGS style endpoint, like all_hour.geojson
+FEED_WINDOW_MS = 3600000
+
+# Return system millisecond count
+def millis():
+	return int(round(time.time() * 1000))
+
+def isoTime(value):
+	return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(value // 1000)) + ".%03d" % (value % 1000)
+
+# Synthetic or recorded event stream shared by the feed handlers
+class ReplayFeed:
+
+	# Class Constructor
+	def __init__(self, rate=1.0, burstEvery=0, burstSize=0, recorded=None, speed=1.0, seed=1):
+		self.rate = rate
+		self.burstEvery = burstEvery
+		self.burstSize = burstSize
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		# Events visible to clients, oldest first: dicts with id, time, lon, lat, depth, mag, place
+		self.events = []
+		# Event id -> wall clock ms when it became visible
+		self.published = {}
+		self.version = 0
+		self.nextID = 0
+		self.startTime = millis()
+		self.lastTick = self.startTime
+		self.lastBurst = self.startTime
+		self.carry = 0.0
+		self.pending = self.loadRecorded(recorded, speed) if recorded else None
+
+	# Recorded features replayed in origin order with their gaps divided by speed
+	def loadRecorded(self, filename, speed):
+		with open(filename) as feedFile:
+			features = json.load(feedFile)['features']
+		features.sort(key=lambda feature: feature['properties']['time'])
+		if not features:
+			return []
+		firstTime = features[0]['properties']['time']
+		pending = []
+		for feature in features:
+			coordinates = feature['geometry']['coordinates']
+			delay = (feature['properties']['time'] - firstTime) / speed
+			pending.append((self.startTime + delay, {
+				'id': feature['id'],
+				'lon': coordinates[0],
+				'lat': coordinates[1],
+				'depth': coordinates[2],
+				'mag': feature['properties'].get('mag'),
+				'place': feature['properties'].get('place') or '',
+			}))
+		pending.reverse()
+		return pending
+
+	def syntheticEvent(self):
+		self.nextID += 1
+		return {
+			'id': 'bench%d' % self.nextID,
+			'lon': round(self.random.uniform(-180, 180), 3),
+			'lat': round(self.random.uniform(-70, 70), 3),
+			'depth': round(self.random.uniform(0, 300), 1),
+			'mag': round(self.random.uniform(0.5, 7.5), 1),
+			'place': '10 km N of Bench %d' % (self.nextID % 97),
+		}
+
+	# Publish everything that is due, call with the lock held
+	def advance(self):
+		now = millis()
+		due = []
+		if self.pending is not None:
+			while self.pending and self.pending[-1][0] <= now:
+				due.append(self.pending.pop()[1])
+		else:
+			self.carry += self.rate * (now - self.lastTick) / 1000.0
+			while self.carry >= 1:
+				due.append(self.syntheticEvent())
+				self.carry -= 1
+			if self.burstEvery and now - self.lastBurst >= self.burstEvery * 1000:
+				due.extend(self.syntheticEvent() for _ in range(self.burstSize))
+				self.lastBurst = now
+		self.lastTick = now
+
+		for event in due:
+			event['time'] = now
+			self.events.append(event)
+			self.published[event['id']] = now
+		if due:
+			self.version += 1
+
+		# Keep the served window bounded
+		while self.events and now - self.events[0]['time'] > FEED_WINDOW_MS:
+			self.events.pop(0)
+
+	# USGS summary feed document, newest first
+	def usgsDocument(self):
+		with self.lock:
+			self.advance()
+			features = [{
+				'type': 'Feature',
+				'id': event['id'],
+				'properties': {'mag': event['mag'], 'place': event['place'], 'time': event['time'],
+					'alert': None, 'tsunami': 0},
+				'geometry': {'type': 'Point', 'coordinates': [event['lon'], event['lat'], event['depth']]},
+			} for event in reversed(self.events)]
+			version = self.version
+		return {'type': 'FeatureCollection', 'metadata': {'count': len(features)}, 'features': features}, version
+
+	# seismicportal FDSN query document honouring start, updatedafter, offset, limit and orderby
+	# Events are never revised here, so an event was last updated when it was published
+	def fdsnDocument(self, start=None, limit=None, orderby=None, updatedafter=None, offset=None):
+		with self.lock:
+			self.advance()
+			events = list(self.events)
+		if start is not None:
+			events = [event for event in events if isoTime(event['time']) >= start]
+		if updatedafter is not None:
+			events = [event for event in events if isoTime(event['time']) > updatedafter]
+		if orderby != 'time-asc':
+			events.reverse()
+		if offset is not None:
+			events = events[offset - 1:]
+		if limit is not None:
+			events = events[:limit]
+		features = [{
+			'type': 'Feature',
+			'id': 'eu' + event['id'],
+			'geometry': {'type': 'Point', 'coordinates': [event['lon'], event['lat'], -event['depth']]},
+			'properties': {'unid': 'eu' + event['id'], 'time': isoTime(event['time']) + 'Z',
+				'lastupdate': isoTime(event['time']) + 'Z',
+				'lon': event['lon'], 'lat': event['lat'], 'depth': event['depth'], 'mag': event['mag'],
+				'flynn_region': event['place'].upper()},
+		} for event in events]
+		return {'type': 'FeatureCollection', 'metadata': {'count': len(features)}, 'features': features}
+
+	# Wall clock ms an event (either feed's id) became visible
+	def publishTime(self, eventID):
+		if eventID.startswith('eu'):
+			eventID = eventID[2:]
+		return self.published.get(eventID)
+
+# Stand-in HTTP server for both feeds with fault injection
+class ReplayFeedServer:
+
+	# Class Constructor
+	def __init__(self, feed, port=0, timeoutRate=0.0, malformedRate=0.0, errorRate=0.0, stallSeconds=2.0):
+		self.feed = feed
+		self.timeoutRate = timeoutRate
+		self.malformedRate = malformedRate
+		self.errorRate = errorRate
+		self.stallSeconds = stallSeconds
+		self.random = random.Random(2)
+		self.stats = {'200': 0, '304': 0, 'timeout': 0, 'malformed': 0, 'error': 0}
+		self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handlerClass())
+		self.server.daemon_threads = True
+		self.thread = None
+
+	@property
+	def baseURL(self):
+		return 'http://127.0.0.1:%d' % self.server.server_port
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, name='EQReplay', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def handlerClass(self):
+		replay = self
+
+		class Handler(BaseHTTPRequestHandler):
+
+			def log_message(self, *args):
+				pass
+
+			def reply(self, status, body=b'', headers=None):
+				self.send_response(status)
+				for key, value in (headers or {}).items():
+					self.send_header(key, value)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				try:
+					self.wfile.write(body)
+				except (BrokenPipeError, ConnectionResetError):
+					# Client already gave up, as it should after a stall
+					pass
+
+			def do_GET(self):
+				roll = replay.random.random()
+				if roll < replay.timeoutRate:
+					replay.stats['timeout'] += 1
+					time.sleep(replay.stallSeconds)
+					try:
+						return self.reply(504)
+					except (BrokenPipeError, ConnectionResetError):
+						return
+				roll -= replay.timeoutRate
+				if roll < replay.errorRate:
+					replay.stats['error'] += 1
+					return self.reply(500)
+				roll -= replay.errorRate
+				malformed = roll < replay.malformedRate
+
+				url = urlparse(self.path)
+				if url.path.endswith('.geojson'):
+					document, version = replay.feed.usgsDocument()
+					etag = '"v%d"' % version
+					if not malformed and self.headers.get('If-None-Match') == etag:
+						replay.stats['304'] += 1
+						return self.reply(304, headers={'ETag': etag})
+					headers = {'ETag': etag, 'Content-Type': 'application/json'}
+				elif url.path.endswith('/query'):
+					query = parse_qs(url.query)
+					document = replay.feed.fdsnDocument(
+						start=query.get('start', [None])[0],
+						limit=int(query['limit'][0]) if 'limit' in query else None,
+						orderby=query.get('orderby', [None])[0],
+						updatedafter=query.get('updatedafter', [None])[0],
+						offset=int(query['offset'][0]) if 'offset' in query else None)
+					headers = {'Content-Type': 'application/json'}
+				else:
+					return self.reply(404)
+
+				body = json.dumps(document).encode()
+				if malformed:
+					replay.stats['malformed'] += 1
+					body = body[:len(body) // 2]
+				else:
+					replay.stats['200'] += 1
+				self.reply(200, body, headers)
+
+		return Handler
+
+def percentile(values, fraction):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# Drive the real acquisition and ingest path against the replay server
+def runBenchmark(args):
+	if args.headless:
+		os.environ['SDL_VIDEODRIVER'] = 'dummy'
+
+	# Imported here so the headless driver is picked before pygame starts
+	import EQMap
+	from functools import partial
+	from EventDB import eventDB
+	from EQEventGatherer import EQEventGatherer
+	from SourceRegistry import FeedSource, sourceRegistry
+	from AcquisitionEngine import acquisitionEngine
+
+	feed = ReplayFeed(rate=args.rate, burstEvery=args.burst_every, burstSize=args.burst_size,
+		recorded=args.recorded, speed=args.speed)
+	server = ReplayFeedServer(feed, timeoutRate=args.timeout_rate, malformedRate=args.malformed_rate,
+		errorRate=args.error_rate, stallSeconds=args.request_timeout * 2)
+	server.start()
+
+	sources = [
+		FeedSource('bench-usgs', server.baseURL + '/summary/all_hour.geojson', kind='feed',
+			intervalMs=args.poll_ms, priority=2, timeout=args.request_timeout),
+		FeedSource('bench-eu', server.baseURL + '/fdsnws/event/1/query', kind='fdsn',
+			intervalMs=args.poll_ms, priority=1, limit=args.eu_limit, timeout=args.request_timeout),
+	]
+	# Registered like the live sources, so ingestUpdates() merges them by priority, and the live ones stand aside
+	liveSources = sourceRegistry.getSources()
+	for source in liveSources:
+		source.enabled = False
+	for source in sources:
+		if source.name == 'bench-eu' and args.usgs_only:
+			continue
+		sourceRegistry.register(source)
+	for source in sourceRegistry.getSources():
+		gatherer = EQEventGatherer(source, isKnown=eventDB.hasEvent)
+		acquisitionEngine.addSource(source.name, partial(EQMap.fetchSource, gatherer), source.intervalMs)
+
+	# Remember each ingested batch so its latency can be taken after the repaint
+	latencies = []
+	startCount = eventDB.numberOfEvents()
+	ingestEvents = EQMap.ingestEvents
+	batch = []
+	def trackingIngestEvents(events):
+		batch.extend(events)
+		return ingestEvents(events)
+	EQMap.ingestEvents = trackingIngestEvents
+
+	repaints = 0
+	ingestSeconds = 0.0
+	startTime = time.time()
+	acquisitionEngine.start()
+	try:
+		while time.time() - startTime < args.duration:
+			ingestStart = time.perf_counter()
+			if EQMap.ingestUpdates():
+				repaints += 1
+			ingestSeconds += time.perf_counter() - ingestStart
+			# Latency runs from publish on the server to the end of the repaint
+			paintedAt = millis()
+			for event in batch:
+				published = feed.publishTime(event.id)
+				if published is not None:
+					latencies.append(paintedAt - published)
+			del batch[:]
+			time.sleep(0.01)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		acquisitionEngine.stop()
+		server.stop()
+		EQMap.ingestEvents = ingestEvents
+		for source in sources:
+			sourceRegistry.unregister(source.name)
+		for source in liveSources:
+			source.enabled = True
+
+	elapsed = time.time() - startTime
+	accepted = eventDB.numberOfEvents() - startCount
+	print("published events: ", len(feed.published))
+	print("ingested events:  ", accepted, "(%.1f events/sec)" % (accepted / elapsed))
+	print("ingest throughput:", "%.0f events/sec of ingest+repaint time" % (accepted / ingestSeconds if ingestSeconds else 0))
+	print("repaints:         ", repaints)
+	print("latency ms:        mean %.0f  p50 %d  p95 %d  max %d" % (
+		sum(latencies) / len(latencies) if latencies else 0,
+		percentile(latencies, 0.5), percentile(latencies, 0.95), max(latencies) if latencies else 0))
+	print("server responses: ", server.stats)
+	# Both feeds carry the same quakes, the higher priority copy wins when they arrive together
+	euKept = sum(1 for eventID in eventDB.eventIDs if str(eventID).startswith('eu'))
+	print("copies kept:      ", "bench-usgs (priority %d) %d, bench-eu (priority %d) %d" % (
+		sources[0].priority, len(eventDB.eventIDs) - euKept, sources[1].priority, euKept))
+	return 0
+
+def main():
+	parser = argparse.ArgumentParser(description="EQMap feed replay server and ingestion benchmark")
+	parser.add_argument('--duration', type=float, default=30, help="seconds to run")
+	parser.add_argument('--rate', type=float, default=2.0, help="synthetic events per second")
+	parser.add_argument('--burst-every', type=float, default=10, help="seconds between bursts, 0 for none")
+	parser.add_argument('--burst-size', type=int, default=100, help="events per burst")
+	parser.add_argument('--recorded', help="replay a saved GeoJSON feed instead of synthetic events")
+	parser.add_argument('--speed', type=float, default=60, help="recorded replay speed up")
+	parser.add_argument('--poll-ms', type=int, default=1000, help="poll interval per source")
+	parser.add_argument('--eu-limit', type=int, default=100, help="FDSN limit per incremental poll")
+	parser.add_argument('--request-timeout', type=float, default=1.0, help="client timeout in seconds")
+	parser.add_argument('--timeout-rate', type=float, default=0.0, help="fraction of requests that stall")
+	parser.add_argument('--malformed-rate', type=float, default=0.0, help="fraction of truncated bodies")
+	parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of HTTP 500 replies")
+	parser.add_argument('--usgs-only', action='store_true', help="only poll the GeoJSON feed")
+	parser.add_argument('--headless', action='store_true', help="render to an offscreen display")
+	parser.add_argument('--serve', action='store_true', help="only run the replay server")
+	parser.add_argument('--port', type=int, default=8080, help="port for --serve")
+	args = parser.parse_args()
+
+	if args.serve:
+		feed = ReplayFeed(rate=args.rate, burstEvery=args.burst_every, burstSize=args.burst_size,
+			recorded=args.recorded, speed=args.speed)
+		server = ReplayFeedServer(feed, port=args.port, timeoutRate=args.timeout_rate,
+			malformedRate=args.malformed_rate, errorRate=args.error_rate)
+		print("Replay feeds at " + server.baseURL + "/summary/all_hour.geojson and /fdsnws/event/1/query")
+		try:
+			server.server.serve_forever()
+		except KeyboardInterrupt:
+			server.server.server_close()
+		return 0
+	return runBenchmark(args)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,160 @@
+"""
+This code defines the compact earthquake event record shared by the gatherers and the app
+Each feed feature is normalized into an EQEvent in a single pass so nothing walks the raw
+JSON again or converts the same field twice
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+import codecs
+import json
+import re
+
+# Start of the features array in a GeoJSON FeatureCollection
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+
+# id, origin time (epoch ms), lon, lat, depth (km), mag, alert, tsunami, place, source,
+# plus the last revision time (epoch ms) and review status ('deleted' marks a retraction) when the feed has them
+EQEvent = namedtuple('EQEvent', ['id', 'time', 'lon', 'lat', 'depth', 'mag', 'alert', 'tsunami', 'place', 'source',
+	'updated', 'status'], defaults=(None, None))
+
+# Convert an FDSN ISO time string (2024-01-15T10:20:30.5Z) to epoch milliseconds
+def isoToMillis(value):
+	try:
+		value = str(value).rstrip('Z')
+		if '+' in value[10:]:
+			value = value[:10] + value[10:].split('+')[0]
+		if '.' in value:
+			base, fraction = value.split('.', 1)
+		else:
+			base, fraction = value, '0'
+		eventTime = datetime.strptime(base, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+		return int(eventTime.timestamp()) * 1000 + int((fraction + '000')[:3])
+	except (TypeError, ValueError):
+		return None
+
+# Convert epoch milliseconds back to the FDSN query time format
+def millisToISO(value):
+	eventTime = datetime.fromtimestamp(value // 1000, timezone.utc)
+	return eventTime.strftime("%Y-%m-%dT%H:%M:%S") + ".%03d" % (value % 1000)
+
+# Since we are on a map remove the "xx km H of " from the start of the string and use best location name
+def shortPlace(place):
+	if not place:
+		return ""
+	place = str(place)
+	marker = " of "
+	if marker in place:
+		return place.split(marker)[1]
+	return place
+
+# First float found under any of the keys, or None
+def firstFloat(properties, keys):
+	for key in keys:
+		try:
+			return float(properties[key])
+		except (KeyError, TypeError, ValueError):
+			continue
+	return None
+
+# Normalize one GeoJSON / FDSN JSON feature from any source into an EQEvent
+# Handles both the USGS shape (geometry coordinates, epoch ms time, place) and the
+# seismicportal shape (lon/lat/depth properties, ISO time, flynn_region)
+# Returns None if the feature has no usable id, time or position
+def fromFeature(feature, source=''):
+	try:
+		properties = feature['properties']
+		eventID = feature.get('id') or properties.get('unid') or properties.get('eventid')
+	except (AttributeError, KeyError, TypeError):
+		return None
+	if eventID is None:
+		return None
+
+	try:
+		coordinates = feature['geometry']['coordinates']
+	except (KeyError, TypeError):
+		coordinates = []
+
+	eventTime = properties.get('time')
+	if isinstance(eventTime, (int, float)):
+		eventTime = int(eventTime)
+	else:
+		eventTime = isoToMillis(eventTime)
+
+	lon = firstFloat(properties, ('lon', 'longitude'))
+	lat = firstFloat(properties, ('lat', 'latitude'))
+	try:
+		if lon is None:
+			lon = float(coordinates[0])
+		if lat is None:
+			lat = float(coordinates[1])
+	except (IndexError, TypeError, ValueError):
+		return None
+	if eventTime is None:
+		return None
+
+	# GeoJSON depth is positive down in USGS feeds and negative (elevation) in some FDSN servers
+	depth = firstFloat(properties, ('depth',))
+	if depth is None:
+		try:
+			depth = abs(float(coordinates[2]))
+		except (IndexError, TypeError, ValueError):
+			depth = 0.0
+
+	mag = firstFloat(properties, ('mag', 'magnitude'))
+	mag = round(mag, 2) if mag is not None else 0.0
+
+	place = properties.get('place') or properties.get('flynn_region') or properties.get('region') or ""
+
+	updated = properties.get('updated', properties.get('lastupdate'))
+	if updated is not None and not isinstance(updated, (int, float)):
+		updated = isoToMillis(updated)
+
+	return EQEvent(eventID, eventTime, round(lon, 2), round(lat, 2), depth, mag,
+		properties.get('alert'), properties.get('tsunami') or 0, shortPlace(place), source,
+		updated, properties.get('status'))
+
+# Stream the features of a GeoJSON FeatureCollection from an iterable of byte chunks
+# Only one chunk and the feature being decoded are held in memory at a time
+def iterGeoJSONFeatures(chunks):
+	decoder = json.JSONDecoder()
+	utf8 = codecs.getincrementaldecoder('utf-8')()
+	buffer = ''
+	position = 0
+	inFeatures = False
+	chunks = iter(chunks)
+
+	while True:
+		if not inFeatures:
+			# Skip everything up to the start of the features array
+			match = FEATURES_START.search(buffer)
+			if match:
+				inFeatures = True
+				position = match.end()
+				continue
+			else:
+				# Keep a tail in case the key is split across chunks
+				buffer = buffer[-32:]
+		else:
+			while True:
+				# Step over separators between features
+				while position < len(buffer) and buffer[position] in ' \t\r\n,':
+					position += 1
+				if position >= len(buffer):
+					break
+				if buffer[position] == ']':
+					return
+				try:
+					feature, position = decoder.raw_decode(buffer, position)
+				except json.JSONDecodeError:
+					# Feature is incomplete, read more of the body
+					break
+				yield feature
+			buffer = buffer[position:]
+			position = 0
+
+		chunk = next(chunks, None)
+		if chunk is None:
+			if inFeatures and buffer.strip():
+				raise ValueError("GeoJSON stream ended inside the features array")
+			return
+		buffer += utf8.decode(chunk)
@@ -1,244 +1,264 @@
 """
 This code gathers Earthquake events via an HTTP GET Request from BOTH USGS and EU
-The returned results are processed by a JSON parser and 6 pertinent data items are extracted and returned.
+Any FDSN event service or GeoJSON feed in the SourceRegistry is handled by the same gatherer,
+and each returned feature is parsed once into a compact EQEvent record (see EQEvent.py).
 Concept, Design by: Craig A. Lindley adapted to USGS by SpudGunMan see github
 """
 import json
-import requests, time
-from datetime import datetime, timedelta
-
-class EQEventGathererUSGS:
-
-	def requestEQEvent(self, days=0):
-		max_retries = 5
-		retrycount = 0
-		r = None
-		success = False
-		while retrycount < max_retries:
-			try:
-				# API https://earthquake.usgs.gov/earthquakes/feed/v1.0/geojson.php
-				if days == 30:
-					r = requests.get('https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_month.geojson', timeout=10)
-				elif days == 7:
-					r = requests.get('https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_week.geojson', timeout=10)
-				elif days == 1:
-					r = requests.get('https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_day.geojson', timeout=10)
-				elif days == 0:
-					r = requests.get('https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_hour.geojson', timeout=10)
-
-				# Check if the request was successful
-				r.raise_for_status()
-
-				# If successful, break the loop
-				if r.status_code == 200:
-					success = True
-					break
-			except requests.exceptions.Timeout:
-				retrycount += 1
-			except requests.exceptions.RequestException:
-				retrycount += 1
-			except ValueError:
-				retrycount += 1
-			if retrycount < max_retries:
-				# Backoff to avoid hammering remote APIs during outages.
-				time.sleep(min(2 * retrycount, 10))
-
-		if not success or r is None:
-			self.jsonData = []
+import requests
+from urllib.parse import urlencode
+from FeedSession import feedSession
+from EQEvent import fromFeature, millisToISO, iterGeoJSONFeatures
+
+# Generic gatherer for one FeedSource descriptor
+class EQEventGatherer:
+
+	# isKnown(id) is True for events already stored, e.g. EventDB.hasEvent
+	def __init__(self, source, isKnown=None):
+		self.source = source
+		self.isKnown = isKnown
+		# Parsed EQEvent records from the last successful request, feed order
+		self.events = []
+		self.notModified = False
+		self.requestFailed = False
+		# FDSN sources only: latest revision time (epoch ms) seen, polls ask for events updated after it
+		self.cursorUpdated = None
+		# While a delta spans several full pages: events already read, and the latest revision time in them
+		self.pageOffset = 0
+		self.pageUpdated = None
+		self.newEvents = []
+		# Revision time of every event in the last full feed read, to spot updates and deletions
+		self.revisions = {}
+		self.revisedEvents = []
+
+	# Build an FDSN event query url for this source
+	def queryURL(self, limit=None, start=None, end=None, orderby=None, updatedafter=None, offset=None):
+		params = []
+		if limit is not None:
+			params.append(('limit', limit))
+		if start is not None:
+			params.append(('start', start))
+		if end is not None:
+			params.append(('end', end))
+		if updatedafter is not None:
+			params.append(('updatedafter', updatedafter))
+		if offset is not None:
+			params.append(('offset', offset))
+		if orderby is not None:
+			params.append(('orderby', orderby))
+		params.append(('format', self.source.queryFormat))
+		return self.source.url + '?' + urlencode(params, safe=':')
+
+	# GET and parse one url, single attempt, retries and backoff are scheduled by the caller
+	def requestURL(self, url):
+		self.notModified = False
+		self.requestFailed = False
+		self.newEvents = []
+		self.revisedEvents = []
+		try:
+			r = feedSession.get(url, timeout=self.source.timeout)
+		except requests.exceptions.RequestException:
+			self.requestFailed = True
+			self.events = []
+			return False
+
+		# Feed unchanged since the last poll, keep the parsed data we have
+		if r is None:
+			self.notModified = True
 			return False
 
 		try:
-			self.jsonData = r.json()
+			jsonData = r.json()
 		except json.JSONDecodeError:
 			#print("Failed to decode JSON response.")
-			self.jsonData = []
+			feedSession.forget(url)
+			self.requestFailed = True
+			self.events = []
 			return False
 
-		if not self.jsonData or 'features' not in self.jsonData:
+		if not jsonData or 'features' not in jsonData:
 			#print("No data found in the response.")
-			self.jsonData = []
+			feedSession.forget(url)
+			self.requestFailed = True
+			self.events = []
 			return False
 
 		# Extracting all the important key features.
-		self.jsonData = self.jsonData['features']
+		self.parseFeatures(jsonData['features'])
 		return True
 
-	def getEventID(self):
-		if not hasattr(self, 'jsonData') or self.jsonData is None:
-			return None
-		try:
-			return self.jsonData[0]['id']
-		except (IndexError, KeyError, TypeError):
-			return None
+	# Normalize every feature in one pass, unusable features are dropped
+	def parseFeatures(self, features):
+		name = self.source.name
+		self.events = [event for event in (fromFeature(feature, name) for feature in features) if event is not None]
+
+	# Poll for events past the cursor, feeds are re-read whole and FDSN services return only the delta
+	def requestNewEvents(self):
+		if self.source.kind == 'feed':
+			success = self.requestURL(self.source.url)
+		elif self.cursorUpdated is None:
+			# First poll just seeds the cursor with the newest event
+			success = self.requestURL(self.queryURL(limit=1))
+		else:
+			# Everything published or revised since the cursor, whatever its origin time
+			# A delta bigger than one page is read a page per poll, FDSN offsets count from 1
+			success = self.requestURL(self.queryURL(limit=self.source.limit, updatedafter=millisToISO(self.cursorUpdated),
+				offset=self.pageOffset + 1 if self.pageOffset else None, orderby='time-asc'))
+		if success:
+			if self.source.kind == 'feed':
+				self.findFeedChanges()
+			else:
+				self.advanceCursor()
+		return success
+
+	# Feeds re-list their whole window and USGS often publishes an event after a newer one,
+	# so new events are told apart by ID, never by origin time: an ID missing from the last
+	# read, or not stored yet, is new. A listed ID with a new revision time was updated
+	def findFeedChanges(self):
+		newEvents = []
+		revised = []
+		revisions = {}
+		for event in self.events:
+			revisions[event.id] = event.updated
+			if event.id not in self.revisions or (self.isKnown is not None and not self.isKnown(event.id)):
+				newEvents.append(event)
+			elif event.updated != self.revisions[event.id]:
+				revised.append(event)
+		newEvents.sort(key=lambda event: event.time)
+		self.revisions = revisions
+		self.revisedEvents = revised
+		self.newEvents = newEvents
+
+	# Split the returned events into new ones and revisions of stored ones, like the feeds do
+	# The cursor moves to the latest revision time once the last page of the delta is read
+	def advanceCursor(self):
+		newEvents = []
+		revised = []
+		for event in self.events:
+			if self.isKnown is not None and self.isKnown(event.id):
+				revised.append(event)
+			else:
+				newEvents.append(event)
+		newEvents.sort(key=lambda event: event.time)
+		self.newEvents = newEvents
+		self.revisedEvents = revised
+		if self.events:
+			pageUpdated = max(updatedTime(event) for event in self.events)
+			self.pageUpdated = pageUpdated if self.pageUpdated is None else max(self.pageUpdated, pageUpdated)
+		if self.cursorUpdated is not None and self.source.limit is not None and len(self.events) >= self.source.limit:
+			# More of the delta is waiting, the cursor holds until it is all read
+			self.pageOffset += len(self.events)
+			return
+		self.pageOffset = 0
+		if self.pageUpdated is not None:
+			self.seedCursor([], self.pageUpdated)
+		self.pageUpdated = None
+
+	# Start past already known events (oldest first), e.g. after a backfill
+	# Feeds remember their IDs and revisions, FDSN sources move the revision time cursor
+	def seedCursor(self, events, updated=None):
+		if self.source.kind == 'feed':
+			for event in events:
+				self.revisions.setdefault(event.id, event.updated)
+			return
+		if events:
+			latest = max(updatedTime(event) for event in events)
+			updated = latest if updated is None else max(updated, latest)
+		if updated is not None and (self.cursorUpdated is None or updated > self.cursorUpdated):
+			self.cursorUpdated = updated
+
+	# Events the last poll found that are not stored yet, oldest first
+	def getNewEvents(self):
+		return list(self.newEvents)
+
+	# Already seen events the last poll reported with a new revision
+	def getRevisedEvents(self):
+		return list(self.revisedEvents)
+
+	# Today's (or any) history since an epoch ms time, streamed where the source allows
+	def backfillEvents(self, since, limit=2000):
+		if self.source.kind == 'feed':
+			events = self.streamFeatures(self.source.backfillUrl or self.source.url)
+		elif self.requestURL(self.queryURL(limit=limit, start=millisToISO(since), orderby='time-asc')):
+			events = self.events
+		else:
+			events = []
+		return [event for event in events if event.time >= since]
+
+	def getEvents(self):
+		return self.events
 
-	def getMag(self):
+	# Generator of records parsed incrementally from a streamed GeoJSON body
+	def streamFeatures(self, url, chunkSize=65536):
+		self.notModified = False
+		self.requestFailed = False
 		try:
-			mag = self.jsonData[0]['properties']['mag']
-			if mag is None:
-				return 0.0
-			return float(("%.2f" % float(mag)))
-		except (IndexError, KeyError, TypeError, ValueError):
-			return 0.0
-
-	def getLocation(self):
+			r = feedSession.get(url, timeout=self.source.timeout, stream=True)
+		except requests.exceptions.RequestException:
+			self.requestFailed = True
+			return
+		if r is None:
+			self.notModified = True
+			return
+		name = self.source.name
 		try:
-			self.place = self.jsonData[0]['properties']['place']
-		except:
-			self.place = ""
-		# Since we are on a map remove the "xx km H of " from the start of the string and use best location name
-		self.marker = " of "
-		if self.marker in self.place:
-			self.place = self.place.split(self.marker)
-			return str(self.place[1])
-		else:
-			#print("Debug USGS Name Split Error: ",place)  #DEBUG 
-			return str(self.place)
-			
-	def getAlert(self):
+			for feature in iterGeoJSONFeatures(r.iter_content(chunkSize)):
+				event = fromFeature(feature, name)
+				if event is not None:
+					yield event
+		except (requests.exceptions.RequestException, ValueError):
+			# Truncated or malformed body, make sure the next request downloads it again
+			feedSession.forget(url)
+			self.requestFailed = True
+		finally:
+			r.close()
+
+	def getEvent(self, index=0):
 		try:
-			self.alert = self.jsonData[0]['properties']['alert']
-			return self.alert
-		except (IndexError, KeyError, TypeError):
-			return ""
+			return self.events[index]
+		except IndexError:
+			return None
 
-	def getTsunami(self):
-		try:
-			self.tsunami = self.jsonData[0]['properties']['tsunami']
-			return self.tsunami
-		except (IndexError, KeyError, TypeError):
-			return ""
+	def getEventID(self, index=0):
+		event = self.getEvent(index)
+		return event.id if event else None
 
-	def getLon(self):
-		try:
-			self.lon = float(self.jsonData[0]['geometry']['coordinates'][0])
-			return float(("%.2f" % self.lon))
-		except (IndexError, KeyError, TypeError, ValueError):
-			return ""
+	# Origin time in epoch milliseconds
+	def getEventTime(self, index=0):
+		event = self.getEvent(index)
+		return event.time if event else None
 
-	def getLat(self):
-		try:
-			self.lat = float(self.jsonData[0]['geometry']['coordinates'][1])
-			return float(("%.2f" % self.lat))
-		except (IndexError, KeyError, TypeError, ValueError):
-			return ""
+	def getLon(self, index=0):
+		event = self.getEvent(index)
+		return event.lon if event else ""
 
-	def getDepth(self):
-		try:
-			return float(self.jsonData[0]['geometry']['coordinates'][2])
-		except (IndexError, KeyError, TypeError, ValueError):
-			return ""
-
-class EQEventGathererEU:
-
-	def requestEQEvent(self, limit=1, days=0):
-		currentRTC = datetime.now()
-
-		if days > 1:
-			startAdjusted = datetime.today() - timedelta(days=days)
-			startQuery = startAdjusted.strftime("%Y-%m-%dT00:00:00") #https://strftime.org
-			endQuery = currentRTC.strftime("%Y-%m-%dT23:59:59")
-			start=startQuery
-			end=endQuery
-			requestTime = '&start=' + start + '&end=' + end
-			print(requestTime)
-		
-		if days == 1:
-			startQuery = currentRTC.strftime("%Y-%m-%dT00:00:00") #https://strftime.org
-			endQuery = currentRTC.strftime("%Y-%m-%dT23:59:59")
-			start=startQuery
-			end=endQuery
-			requestTime = '&start=' + start + '&end=' + end
-
-		if days == 0:
-			start=''
-			end=''
-			requestTime = ''
-
-		max_retries = 5
-		retrycount = 0
-		success = False
-		while retrycount < max_retries:
-			try:
-				self.r = requests.get(
-					'https://www.seismicportal.eu/fdsnws/event/1/query?limit=' + str(limit) + requestTime + '&format=json',
-					timeout=10  # Set a timeout to avoid hanging indefinitely
-				)
-				self.r.raise_for_status()  # Raise an HTTPError for bad responses (4xx and 5xx)
-				success = True
-				break  # Exit the loop if the request is successful
-			except requests.exceptions.Timeout:
-				retrycount += 1
-			except requests.exceptions.RequestException:
-				retrycount += 1
-			if retrycount < max_retries:
-				# Backoff to avoid hammering remote APIs during outages.
-				time.sleep(min(2 * retrycount, 10))
-
-		if not success:
-			self.jsonData = None
-			return False
+	def getLat(self, index=0):
+		event = self.getEvent(index)
+		return event.lat if event else ""
 
-		try:
-			self.jsonData = self.r.json()  # Use the built-in JSON parser for better error handling
-		except json.JSONDecodeError:
-			self.jsonData = None
-			return False
+	def getDepth(self, index=0):
+		event = self.getEvent(index)
+		return event.depth if event else ""
 
-		if not self.jsonData or 'features' not in self.jsonData:
-			self.jsonData = None
-			return False
+	def getMag(self, index=0):
+		event = self.getEvent(index)
+		return event.mag if event else 0.0
 
-		return True
+	def getLocation(self, index=0):
+		event = self.getEvent(index)
+		return event.place if event else ""
 
-	def getEventID(self):
-		if not hasattr(self, 'jsonData') or self.jsonData is None:
-			return None
-		try:
-			return self.jsonData['features'][0]['id']
-		except (IndexError, KeyError, TypeError):
-			return None
+	def getAlert(self, index=0):
+		event = self.getEvent(index)
+		return event.alert if event else ""
 
-	def getLon(self):
-		if not hasattr(self, 'jsonData') or self.jsonData is None:
-			return ""
-		try:
-			self.lon = float(self.jsonData['features'][0]['properties']['lon'])
-			return float(("%.2f" % self.lon))
-		except (IndexError, KeyError, TypeError, ValueError):
-			return ""
-
-	def getLat(self):
-		if not hasattr(self, 'jsonData') or self.jsonData is None:
-			return ""
-		try:
-			lat = float(self.jsonData['features'][0]['properties']['lat'])
-			return float(("%.2f" % lat))
-		except (IndexError, KeyError, TypeError, ValueError):
-			return ""
-
-	def getMag(self):
-		if not hasattr(self, 'jsonData') or self.jsonData is None:
-			return ""
-		try:
-			return float(self.jsonData['features'][0]['properties']['mag'])
-		except (IndexError, KeyError, TypeError, ValueError):
-			return ""
-	
-	def getDepth(self):
-		if not hasattr(self, 'jsonData') or self.jsonData is None:
-			return ""
-		try:
-			return float(self.jsonData['features'][0]['properties']['depth'])
-		except (IndexError, KeyError, TypeError, ValueError):
-			return ""
+	def getTsunami(self, index=0):
+		event = self.getEvent(index)
+		return event.tsunami if event else ""
 
-	def getLocation(self):
-		if not hasattr(self, 'jsonData') or self.jsonData is None:
-			return ""
-		try:
-			return self.jsonData['features'][0]['properties']['flynn_region']
-		except (IndexError, KeyError, TypeError):
-			return ""
+# Revision time of an event in epoch ms, its origin time if the source gives none
+def updatedTime(event):
+	return event.updated if event.updated is not None else event.time
 
 class EQEventGathererUSGSVolcanoAlert:
     def __init__(self, lat=0, lon=0, ignore_words=None, ignore_enable=False):
@@ -260,11 +280,20 @@ class EQEventGathererUSGSVolcanoAlert:
         url = "https://volcanoes.usgs.gov/hans-public/api/volcano/getCapElevated"
         self.lat = lat if lat is not None else self.lat
         self.lon = lon if lon is not None else self.lon
+        self.requestFailed = False
         try:
-            r = requests.get(url, timeout=10)
-            r.raise_for_status()
-            self.jsonData = r.json()
+            r = feedSession.get(url, timeout=10)
+            # A 304 keeps the last alert list, it is only filtered again below
+            if r is not None:
+                self.jsonData = r.json()
+        except ValueError:
+            # Undecodable body, also catches requests' JSONDecodeError
+            feedSession.forget(url)
+            self.requestFailed = True
+            self.jsonData = []
+            return False
         except requests.exceptions.RequestException:
+            self.requestFailed = True
             self.jsonData = []
             return False
 
@@ -301,29 +330,15 @@ class EQEventGathererUSGSVolcanoAlert:
 
 				
 # Return a class instance
-eqGathererEU = EQEventGathererEU()
-eqGathererUSGS = EQEventGathererUSGS()
 eqGathererUSGSVolcano = EQEventGathererUSGSVolcanoAlert()
 '''
 # Test Code
-eqGathererEU.requestEQEvent()
-print(eqGathererEU.getEventID())
-print(eqGathererEU.getLocation())
-print(eqGathererEU.getMag())
-print(eqGathererEU.getLon())
-print(eqGathererEU.getLat())
-print(eqGathererEU.getDepth())
-
-
-eqGathererUSGS.requestEQEvent()
-print(eqGathererUSGS.getEventID())
-print(eqGathererUSGS.getLocation())
-print(eqGathererUSGS.getMag())
-print(eqGathererUSGS.getLon())
-print(eqGathererUSGS.getLat())
-print(eqGathererUSGS.getDepth())
-print(eqGathererUSGS.getTsunami())
-print(eqGathererUSGS.getAlert())
+from SourceRegistry import sourceRegistry
+for source in sourceRegistry.getSources():
+	eqGatherer = EQEventGatherer(source)
+	eqGatherer.requestNewEvents()
+	print(source.name, eqGatherer.getEventID(), eqGatherer.getLocation(), eqGatherer.getMag(),
+		eqGatherer.getLon(), eqGatherer.getLat(), eqGatherer.getDepth())
 
 volcano_gatherer = EQEventGathererUSGSVolcanoAlert(lat=34, lon=-118, ignore_words=['Shasta'])
 '''
@@ -6,16 +6,20 @@ Concept, Design by: Craig A. Lindley
 """
 
 import time
+import threading
 from datetime import datetime, timedelta
+from functools import partial
 from DisplayManager import displayManager
-from EQEventGatherer import eqGathererEU
-from EQEventGatherer import eqGathererUSGS
+from EQEventGatherer import EQEventGatherer
 from EventDB import eventDB
 from EQEventGatherer import EQEventGathererUSGSVolcanoAlert
+from AcquisitionEngine import acquisitionEngine, SourceUnavailable
+from SourceRegistry import sourceRegistry
 
 # Data Sourcing
-use_eu = True
-use_usgs = True
+# Earthquake sources live in SourceRegistry, e.g. sourceRegistry.setEnabled('eu', False)
+# or sourceRegistry.register(FeedSource(...)) for a regional FDSN network
+eqGatherers = {}
 eqGathererUSGSVolcano = EQEventGathererUSGSVolcanoAlert()
 volcanoAlerts = []
 
@@ -25,23 +29,28 @@ WHITE  = (255, 255, 255)
 RED    = (255, 0, 0)
 YELLOW = (255, 255, 0)
 
-# Acquire new EQ data every 30 seconds
-ACQUISITION_TIME_MS = 30000
+# Earthquake sources set their own poll interval, the volcano feed is polled every minute
+VOLCANO_ACQUISITION_TIME_MS = 60000
+
+# Startup backfill of today's history
+BACKFILL_LIMIT = 2000
+BACKFILL_CHUNK_SIZE = 500
+BACKFILL_TIMEOUT_S = 30
 
 # Blink every .5 seconds
 BLINK_TIME_MS = 500
 
+# The current quake and this many of the newest events blink
+BLINK_EVENTS = 3
+
 # Wash/Title page display every 15 minutes
 TITLEPAGE_DISPLAY_TIME_MS = 900000
 
 # Times in the future for actions to occur
-ftForAcquisition = 0
 ftForBlink = 0
 ftForTitlePageDisplay = 0
 
 # Current quake data
-cqIDUK  = ""
-cqIDUSGS = ""
 cqLocation = "loading..."
 cqLon = 0.0
 cqLat = 0.0
@@ -49,26 +58,81 @@ cqMag = 0.0
 cqDepth = 0.0
 cqAlert = None
 cqTsunami = 0
-dataToggle = False
 blinkToggle = False
 largestLOC = ''
 
+# Events already drawn on the display's base layer, by DB sequence number and layout generation
+plottedSeq = 0
+plottedGeneration = -1
+
 # Return system millisecond count
 def millis():
 	return int(round(time.time() * 1000))
 
+# Draw events added since the last repaint onto the base layer, and clear the ones evicted since,
+# or start it over if events were revised, removed or reloaded
+def syncEventLayer(full=False):
+	global plottedSeq, plottedGeneration
+
+	count = eventDB.numberOfEvents()
+	evicted = eventDB.takeEvicted()
+	if full or plottedGeneration != eventDB.layoutGeneration or not displayManager.hasBaseLayer():
+		if not displayManager.resetBaseLayer():
+			return False
+		plottedSeq = eventDB.seqHead - count
+		plottedGeneration = eventDB.layoutGeneration
+		evicted = []
+
+	displayManager.beginBaseLayer()
+	try:
+		# Put the map back under the evicted markers and redraw what overlaps them, oldest first
+		largestMag = eventDB.getLargestEvent()[0]
+		for area in displayManager.eraseMarkers(evicted):
+			try:
+				for lon, lat, mag, alert, tsunami, location in reversed(
+						eventDB.query_bbox(*displayManager.redrawArea(area, largestMag))):
+					if displayManager.markerReaches(lon, lat, mag):
+						displayManager.mapEarthquake(lon, lat, mag, displayManager.colorFromMag(mag))
+			finally:
+				displayManager.endRedraw()
+
+		# New events are at the front of the queue, draw oldest first so the newest ends on top
+		for i in range(min(eventDB.seqHead - plottedSeq, count) - 1, -1, -1):
+			lon, lat, mag, alert, tsunami, location = eventDB.getEvent(i)
+			# Color depends upon magnitude
+			color = displayManager.colorFromMag(mag)
+			displayManager.mapEarthquake(lon, lat, mag, color)
+	finally:
+		displayManager.endLayer()
+	plottedSeq = eventDB.seqHead
+	return True
+
+# (lon, lat, mag) of the current quake and the newest events, to blink on the map
+def blinkMarkers():
+	markers = [(cqLon, cqLat, cqMag)]
+	for i in range(min(BLINK_EVENTS, eventDB.numberOfEvents())):
+		lon, lat, mag, alert, tsunami, location = eventDB.getEvent(i)
+		if (lon, lat, mag) not in markers:
+			markers.append((lon, lat, mag))
+	return markers
+
 # Repaint the map from the events in the DB
-def repaintMap():
+def repaintMap(full=False):
 	global volcanoAlerts
 
 	highestMag, trending, max_location = eventDB.getLargestEvent()
 	highestMag = str(highestMag)
 	eventCount = eventDB.numberOfEvents()
+	displayManager.setBlinkMarkers(blinkMarkers())
 	displayManager.beginFrame()
 	try:
 
-		# Display fresh map
-		displayManager.displayMap()
+		# Map and events come from the base layer, only new events are drawn
+		if not syncEventLayer(full):
+			displayManager.displayMap()
+
+		# Text and markers go on the overlay
+		displayManager.beginOverlay()
 
 		# Display current local time upper left
 		displayManager.displayCurrentTime()
@@ -87,15 +151,6 @@ def repaintMap():
 			displayManager.displayDBStats(cqMag, eventCount, highestMag, cqTsunami, cqAlert, cluster=True)
 		else:
 			displayManager.displayDBStats(cqMag, eventCount, highestMag, cqTsunami, cqAlert)
-	
-		# Display all of the EQ events in the DB as circles
-		count = eventDB.numberOfEvents()
-		if count > 0:
-			for i in range(count):
-				lon, lat, mag, alert, tsunami, location = eventDB.getEvent(i)
-				# Color depends upon magnitude
-				color = displayManager.colorFromMag(mag)
-				displayManager.mapEarthquake(lon, lat, mag, color)
 
 		# Draw active volcano alerts as triangle markers.
 		for alert in volcanoAlerts:
@@ -103,7 +158,10 @@ def repaintMap():
 
 		# Draw trend graph last so map plotting does not overwrite labels
 		displayManager.displayTrendingGraph(eventDB.getDayTrend())
+		displayManager.endLayer()
+		displayManager.composite()
 	finally:
+		displayManager.endLayer()
 		displayManager.endFrame()
 	return True
 
@@ -123,130 +181,176 @@ def displayTitlePage():
 		print("Error displaying title page:", e)
 		return False
 
-# getUSGS Function
-def getUpdatesUSGS():
-	global cqIDUSGS,cqLocation,cqLon,cqLat,cqMag,cqDepth,cqTsunami,cqAlert
-	# internet check test
-	try:
-		# Check for new earthquake event
-		success = eqGathererUSGS.requestEQEvent()
-		if not success:
-			return False
-	except Exception:
-		return False
-
-	# Determine if we have seen this event before If so ignore it
-	if cqIDUSGS != eqGathererUSGS.getEventID():
-
-		#if data has no ID dont use it
-		if eqGathererUSGS.getEventID() is None:
-			return False
-		else:
-
-			# Extract the EQ data
-			try:
-				cqLocation = eqGathererUSGS.getLocation()
-				cqLon = eqGathererUSGS.getLon()
-				cqLat = eqGathererUSGS.getLat()
-				cqMag = eqGathererUSGS.getMag()
-				cqDepth = eqGathererUSGS.getDepth()
-				cqTsunami = eqGathererUSGS.getTsunami()
-				cqAlert = eqGathererUSGS.getAlert()
-			except Exception:
-				return False
-
-			# Add new event to DB if it isnt also from the other source
-			if not eventDB.checkDupLonLat(cqLon, cqLat):
-				eventDB.addEvent(cqLon, cqLat, cqMag, cqAlert, cqTsunami, cqLocation)
-
-				# Update the current event ID
-				cqIDUSGS = eqGathererUSGS.getEventID()
-
-				# Display the new EQ data
-				repaintMap()
-				return cqIDUSGS,cqLocation,cqLon,cqLat,cqMag,cqDepth,cqTsunami,cqAlert
-
-	return False
-
-# getEU Function
-def getUpdatesEU():
-	global cqIDUK,cqLocation,cqLon,cqLat,cqMag,cqDepth,cqTsunami,cqAlert
-	# internet check test
-	try:
-		# Check for new earthquake event
-		success = eqGathererEU.requestEQEvent()
-		if not success:
-			return False
-	except Exception:
-		return False
-		
-	# Determine if we have seen this event before If so ignore it
-	if cqIDUK != eqGathererEU.getEventID():
-		# Extract the EQ data
-		cqLocation = eqGathererEU.getLocation()
-		cqLon = eqGathererEU.getLon()
-		cqLat = eqGathererEU.getLat()
-		cqMag = eqGathererEU.getMag()
-		cqDepth = eqGathererEU.getDepth()
-		cqTsunami = 0
-		cqAlert = None
-
-		# Add new event to DB if it isnt also from the other source
-		if not eventDB.checkDupLonLat(cqLon, cqLat):
-			eventDB.addEvent(cqLon, cqLat, cqMag, cqAlert, cqTsunami, cqLocation)
-
-			# Update the current event ID
-			cqIDUK = eqGathererEU.getEventID()
-
-			# Display the new EQ data
-			repaintMap()
-
-def getUpdatesVolcano():
-	global volcanoAlerts
+# Fetch the events past a source's cursor, runs on an acquisition worker thread
+def fetchSource(gatherer):
+	if not gatherer.requestNewEvents():
+		if gatherer.requestFailed:
+			raise SourceUnavailable(gatherer.source.name + " feed request failed")
+		return []
+	# Revisions of events we already have, then every event newer than the last one we have seen, oldest first
+	return gatherer.getRevisedEvents() + gatherer.getNewEvents()
+
+# Fetch the volcano alert set, runs on an acquisition worker thread
+def fetchVolcano():
 	# Query USGS volcano alert feed.
-	try:
-		has_alerts = eqGathererUSGSVolcano.requestEQEvent()
-	except Exception:
-		return False
-
-	if not has_alerts:
-		if volcanoAlerts:
-			volcanoAlerts = []
-			repaintMap()
-		return False
+	if not eqGathererUSGSVolcano.requestEQEvent():
+		if eqGathererUSGSVolcano.requestFailed:
+			raise SourceUnavailable("volcano feed request failed")
+		return []
 
 	ids = eqGathererUSGSVolcano.getEventIDs()
 	locations = eqGathererUSGSVolcano.getLocations()
 	lats = eqGathererUSGSVolcano.getLats()
 	lons = eqGathererUSGSVolcano.getLons()
 
-	new_alerts = []
+	alerts = []
 	for idx, volcano_id in enumerate(ids):
 		lat = lats[idx] if idx < len(lats) else None
 		lon = lons[idx] if idx < len(lons) else None
 		if lat is None or lon is None:
 			continue
-		new_alerts.append({
+		alerts.append({
 			'id': volcano_id,
 			'name': locations[idx] if idx < len(locations) else '',
 			'lat': float(lat),
 			'lon': float(lon)
 		})
-
-	# Repaint only when the alert set changes.
-	if new_alerts != volcanoAlerts:
-		volcanoAlerts = new_alerts
+	return alerts
+
+# Add fetched EQEvent records to the DB, returns True if any were new
+def ingestEvents(events):
+	global cqLocation,cqLon,cqLat,cqMag,cqDepth,cqTsunami,cqAlert
+	added = False
+	newest = None
+	for event in events:
+		eventTime = datetime.fromtimestamp(event.time / 1000)
+		# A known event is a revision, apply it in place
+		if eventDB.hasEvent(event.id):
+			if event.status == 'deleted':
+				added = eventDB.deleteEvent(event.id) or added
+			else:
+				added = eventDB.updateEvent(event.id, event.lon, event.lat, event.mag, event.alert, event.tsunami,
+					event.place, event_time=eventTime) or added
+			continue
+		if event.status == 'deleted':
+			continue
+		# Add new event to DB if it isnt also from another source
+		if eventDB.checkDupLonLat(event.lon, event.lat, event.mag, eventTime, source=event.source):
+			continue
+		if not eventDB.addEvent(event.lon, event.lat, event.mag, event.alert, event.tsunami, event.place,
+				event_time=eventTime, event_id=event.id, depth=event.depth, source=event.source):
+			continue
+		if newest is None or event.time >= newest.time:
+			newest = event
+		added = True
+
+	# Newest added event becomes the current quake, unless an event already stored is newer
+	if newest is not None and eventDB.isNewestEvent(newest.id):
+		cqLocation, cqLon, cqLat, cqMag, cqDepth = newest.place, newest.lon, newest.lat, newest.mag, newest.depth
+		cqTsunami, cqAlert = newest.tsunami, newest.alert
+	return added
+
+# Merge everything the acquisition workers queued and repaint once
+def ingestUpdates():
+	global volcanoAlerts
+	changed = False
+	results = acquisitionEngine.drain()
+	# Higher priority sources go first so their copy of a shared quake is the one kept
+	results.sort(key=lambda item: -sourcePriority(item[0]))
+	for name, result in results:
+		if result is None:
+			continue
+		if name == 'volcano':
+			# Repaint only when the alert set changes.
+			if result != volcanoAlerts:
+				volcanoAlerts = result
+				changed = True
+		elif ingestEvents(result):
+			changed = True
+	eventDB.flushJournal()
+
+	if changed:
 		repaintMap()
+	return changed
+
+def sourcePriority(name):
+	source = sourceRegistry.get(name)
+	return source.priority if source else 0
+
+# One gatherer per enabled source, shared by the backfill cursors and the live pollers
+def setupGatherers():
+	eqGatherers.clear()
+	for source in sourceRegistry.getSources():
+		eqGatherers[source.name] = EQEventGatherer(source, isKnown=eventDB.hasEvent)
+	return eqGatherers
+
+# Fetch today's events from every source, runs on a background thread
+def fetchBackfill():
+	midnight = datetime.combine(datetime.now().date(), datetime.min.time())
+	since = int(midnight.timestamp() * 1000)
+	events = []
+	for source in sourceRegistry.getSources():
+		# Private gatherers so the live pollers' state is not touched
+		try:
+			events.extend(EQEventGatherer(source).backfillEvents(since, limit=BACKFILL_LIMIT))
+		except Exception as e:
+			print("Backfill from " + source.name + " failed:", e)
+	# Oldest first, cross-source repeats are dropped by the DB dedup index on insert
+	events.sort(key=lambda event: event.time)
+	return events
+
+# Start the backfill fetch so it overlaps the title page
+def startBackfill():
+	result = []
+	thread = threading.Thread(target=lambda: result.extend(fetchBackfill()), name='EQBackfill', daemon=True)
+	thread.start()
+	return thread, result, millis() + BACKFILL_TIMEOUT_S * 1000
+
+# Bulk load the backfill into the DB in chunks once its fetch is done
+# Called on every main loop pass so the display never waits on the fetch
+# Returns True once the backfill is loaded or given up on
+def finishBackfill(backfill):
+	global cqLocation,cqLon,cqLat,cqMag,cqDepth,cqTsunami,cqAlert
+	thread, events, deadline = backfill
+	if thread.is_alive():
+		if millis() < deadline:
+			return False
+		print("Backfill timed out, continuing with live data")
+		return True
+	events = list(events)
+
+	added = 0
+	for start in range(0, len(events), BACKFILL_CHUNK_SIZE):
+		added += eventDB.addEvents(events[start:start + BACKFILL_CHUNK_SIZE])
+		# Keep keys responsive between chunks
+		displayManager.handleKeyPress()
+
+	# Start the live pollers after the backfilled history
+	for name, gatherer in eqGatherers.items():
+		gatherer.seedCursor([event for event in events if event.source == name])
+
+	# The history went in front of the events stored since midnight, put it in time order once
+	eventDB.sortByTime()
+
+	# The newest backfilled event is the current quake only if nothing stored is newer
+	last = max(events, key=lambda event: event.time) if events else None
+	if last is not None and eventDB.isNewestEvent(last.id):
+		cqLocation, cqLon, cqLat, cqMag, cqDepth = last.place, last.lon, last.lat, last.mag, last.depth
+		cqTsunami, cqAlert = last.tsunami, last.alert
+	print("Backfill loaded", added, "events")
+	return True
 
-	return bool(volcanoAlerts)
+# Register the enabled sources, each polled on its own schedule
+def startAcquisition():
+	for name, gatherer in eqGatherers.items():
+		acquisitionEngine.addSource(name, partial(fetchSource, gatherer), gatherer.source.intervalMs)
+	acquisitionEngine.addSource('volcano', fetchVolcano, VOLCANO_ACQUISITION_TIME_MS)
+	acquisitionEngine.start()
 
 # Code execution start
 def main():
 	# Setup for global variable access
-	global ftForAcquisition
 	global ftForBlink
-	global cqIDUK
-	global cqIDUSGS
 	global cqLocation
 	global cqLon
 	global cqLat
@@ -255,16 +359,16 @@ def main():
 	global cqTsunami
 	global cqAlert
 	global blinkToggle
-	global dataToggle
 	global largestLOC
 	global volcanoAlerts
 
-	ftForAcquisition = 0
 	ftForBlink = 0
 	volcanoAlerts = []
 	
 
-	last_db_clear_date = None
+	# The DB starts out holding today, so the midnight save and clear waits for the next midnight
+	# (starting between 00:00 and 00:59 must not file today's events as yesterday's)
+	last_db_clear_date = datetime.now().date()
 
 	# True if display is on; false if off
 	displayState = False
@@ -272,11 +376,24 @@ def main():
 	#exit loop handler
 	running = True
 
-	# Load today's saved database on startup
+	# Load today's saved database on startup, then recover anything journaled since
+	# Journals of earlier days go to their day files first
+	try:
+		eventDB.recoverJournals()
+	except OSError as e:
+		print("Event journal recovery failed:", e)
 	try:
 		eventDB.load_today()
 	except Exception:
 		pass
+	try:
+		eventDB.openJournal()
+	except OSError as e:
+		print("Event journal unavailable:", e)
+
+	# Pull today's history while the title page is up
+	setupGatherers()
+	backfill = startBackfill()
 
 	#loop
 	try:
@@ -293,6 +410,7 @@ def main():
 				print("DEBUG: Clearing DB at midnight with ", eventDB.numberOfEvents(), " events in the DB")
 				eventDB.save(save_date=yesterday)
 				eventDB.clear()
+				eventDB.rollJournal()
 				last_db_clear_date = now.date()
 
 			if displayState == False:
@@ -302,48 +420,35 @@ def main():
 				# Display the title page
 				displayTitlePage()
 
-				# Force a redisplay of all quake data
-				repaintMap()
+				# Force a redisplay of all quake data, which also clears evicted events
+				repaintMap(full=True)
+
+			# Load the backfill once it is fetched, then poll all data sources in the background
+			if backfill is not None and finishBackfill(backfill):
+				backfill = None
+				startAcquisition()
+				repaintMap(full=True)
 
 			# Is it time to display the title page ?
 			if millis() > ftForTitlePageDisplay and displayState:
 				displayTitlePage()
 
-				# Force a redisplay of all quake data
-				repaintMap()
+				# Force a redisplay of all quake data, which also clears evicted events
+				repaintMap(full=True)
 				#eventDB.save() #Save Database #DEBUG
 
-			# Is it time to acquire new earthquake data ?
-			if millis() > ftForAcquisition:
-				# server requests from EU and USGS balanced and dupe checked in function
-				if dataToggle:
-					dataToggle = False
-					if use_usgs:
-						getUpdatesUSGS()
-					else:
-						getUpdatesEU()
-						
-				else:
-					dataToggle = True
-					if use_eu:
-						getUpdatesEU()
-					else:
-						getUpdatesUSGS()
-
-				# Always check the volcano feed during acquisition.
-				getUpdatesVolcano()
-				# Schedule the next acquisition
-				ftForAcquisition = millis() + ACQUISITION_TIME_MS
-
-			# Is it time to blink EQ circle?
+			# Merge any new data the acquisition workers have fetched
+			ingestUpdates()
+
+			# Is it time to blink EQ circles?
 			if millis() > ftForBlink:
 
 				if blinkToggle:
-					color = displayManager.colorFromMag(cqMag)
-					displayManager.mapEarthquake(cqLon, cqLat, cqMag, color)
+					# Put back the map and events under the blanked circles
+					displayManager.restoreBlink()
 					blinkToggle = False
 				else:
-					displayManager.mapEarthquake(cqLon, cqLat, cqMag, BLACK)
+					displayManager.blink()
 					blinkToggle = True
 					# Update current display time on the off beat
 					displayManager.displayCurrentTime()
@@ -356,6 +461,7 @@ def main():
 		print("Error in main loop:", e)
 		running = False
 	finally:
+		acquisitionEngine.stop()
 		now = datetime.now()
 		save_date = now.date()
 		if now.hour == 0 and last_db_clear_date != now.date():
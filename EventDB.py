@@ -3,45 +3,229 @@ This code handles a simple database of earthquake events in a list
 Concept, Design and Implementation by: Craig A. Lindley
 """
 from collections import deque, Counter
-from datetime import datetime
+from datetime import datetime, timedelta
+import heapq
+import time
+import math
 import pickle
 import glob
+from EventStore import ColumnarEventStore, COLUMNAR_AVAILABLE
+from EventJournal import EventJournal
+from DayIndex import DayIndex
+from DayFile import DayFile, isDayFile, writeDayFile, notDayFileError
+from SpatialIndex import SpatialIndex
+from Rollups import RollupEngine
 
 #MAX_EVENTS = 200
 
+# Default retention, oldest events are evicted past any of these (None for no limit)
+RETENTION_WINDOW_S = None
+RETENTION_MAX_EVENTS = 50000
+RETENTION_MAX_BYTES = 32 * 1024 * 1024
+# Rough memory cost of one stored event with its index entries, plus its location text
+EVENT_BYTES = 512
+
+# Keep events in numpy columns instead of a deque of tuples, if numpy is installed
+COLUMNAR_STORE = False
+
+# Day files go to the RAM disk when there is one, else the working directory
+RAMDISK_DIR = "/run/shm/"
+
+# Evicted markers kept for the renderer to clear, past this many between repaints a full redraw is cheaper
+EVICTED_MARKERS_MAX = 256
+
+# Rewrite the journal as a checkpoint once it holds this many records more than there are live events
+JOURNAL_COMPACT_SLACK = 1000
+
+# The same quake reported by two sources lands within these tolerances
+# A source gives each of its quakes its own id, so events from one source never match each other
+DEDUP_DEGREES = 0.5
+DEDUP_TIME_S = 120
+DEDUP_MAG = 0.5
+
+# Spatial grid cell plus origin time bucket index for O(1) cross-source duplicate checks
+# Cells and buckets are as wide as the tolerances, so only the 3x3x3 neighbourhood is searched
+# Entries with no source (loaded from day files) match events from any source
+class DedupIndex:
+
+	# Class Constructor
+	def __init__(self, degrees=DEDUP_DEGREES, seconds=DEDUP_TIME_S, magTolerance=DEDUP_MAG):
+		self.degrees = degrees
+		self.seconds = seconds
+		self.magTolerance = magTolerance
+		self.lonCells = int(math.ceil(360.0 / degrees))
+		# (lon cell, lat cell, time bucket) -> list of (lon, lat, mag, time, source)
+		self.cells = {}
+		# Events with no origin time (restored from old day files) match on exact position only
+		self.positions = Counter()
+
+	def clear(self):
+		self.cells.clear()
+		self.positions.clear()
+
+	def _key(self, lon, lat, eventTime):
+		return (int(math.floor((lon + 180.0) / self.degrees)) % self.lonCells,
+			int(math.floor((lat + 90.0) / self.degrees)),
+			int(math.floor(eventTime / self.seconds)))
+
+	def add(self, lon, lat, mag, eventTime, source=None):
+		if eventTime is None:
+			self.positions[(round(lon, 2), round(lat, 2))] += 1
+			return
+		self.cells.setdefault(self._key(lon, lat, eventTime), []).append((lon, lat, mag, eventTime, source))
+
+	def remove(self, lon, lat, mag, eventTime, source=None):
+		if eventTime is None:
+			position = (round(lon, 2), round(lat, 2))
+			self.positions[position] -= 1
+			if self.positions[position] <= 0:
+				del self.positions[position]
+			return
+		key = self._key(lon, lat, eventTime)
+		entries = self.cells.get(key)
+		if entries is None:
+			return
+		try:
+			entries.remove((lon, lat, mag, eventTime, source))
+		except ValueError:
+			return
+		if not entries:
+			del self.cells[key]
+
+	# True if an event indexed from another source is within the position, time and magnitude tolerances
+	# With no source given any indexed event can match
+	def isDuplicate(self, lon, lat, mag, eventTime, source=None):
+		if (round(lon, 2), round(lat, 2)) in self.positions:
+			return True
+		if eventTime is None:
+			return False
+		lonCell, latCell, bucket = self._key(lon, lat, eventTime)
+		for dLon in (-1, 0, 1):
+			for dLat in (-1, 0, 1):
+				for dBucket in (-1, 0, 1):
+					entries = self.cells.get(((lonCell + dLon) % self.lonCells, latCell + dLat, bucket + dBucket))
+					if not entries:
+						continue
+					for otherLon, otherLat, otherMag, otherTime, otherSource in entries:
+						if source is not None and otherSource == source:
+							continue
+						lonDiff = abs(otherLon - lon)
+						if min(lonDiff, 360.0 - lonDiff) > self.degrees:
+							continue
+						if abs(otherLat - lat) > self.degrees or abs(otherTime - eventTime) > self.seconds:
+							continue
+						if mag is not None and otherMag is not None and abs(otherMag - mag) > self.magTolerance:
+							continue
+						return True
+		return False
+
+# How long and how many events EventDB keeps before evicting the oldest
+class RetentionPolicy:
+
+	# Class Constructor
+	def __init__(self, windowS=RETENTION_WINDOW_S, maxEvents=RETENTION_MAX_EVENTS, maxBytes=RETENTION_MAX_BYTES):
+		# Sliding window on origin time, in seconds before now
+		self.windowS = windowS
+		self.maxEvents = maxEvents
+		# Budget for the estimate from eventBytes()
+		self.maxBytes = maxBytes
+
+	# True if the oldest event has to go
+	def shouldEvict(self, count, byteCount, oldestTime, now):
+		if count == 0:
+			return False
+		if self.maxEvents is not None and count > self.maxEvents:
+			return True
+		if self.maxBytes is not None and byteCount > self.maxBytes:
+			return True
+		if self.windowS is not None and oldestTime is not None and oldestTime < now - self.windowS:
+			return True
+		return False
+
+# Estimated memory held for one event
+def eventBytes(event):
+	try:
+		return EVENT_BYTES + len(event[5])
+	except (TypeError, IndexError):
+		return EVENT_BYTES
+
 class EventDB:
 
 	# Class Constructor
-	def __init__(self):
+	def __init__(self, columnar=COLUMNAR_STORE, retention=None):
 		# Create empty queue
 		#self.EQEventQueue = deque(maxlen=MAX_EVENTS)
-		self.EQEventQueue = deque()
-		self.EQElocations = deque()
+		self.columnar = columnar and COLUMNAR_AVAILABLE
+		self.EQEventQueue = ColumnarEventStore() if self.columnar else deque()
+		# Running count of event locations since the active region was last read
+		self.EQElocations = Counter()
+		self.topRegion = None
+		# Events with a sequence number from here on are in the location count
+		self.regionSince = 0
 		self.dailyevents = []
 		self.mySettings = []
 		self.EQEventQueue.clear()
 		self.EQElocations.clear()
 		self.dailyevents.clear()
-		self.EQdailyTrend = []
-		self.EQdailyTrend.clear()
 		self.mySettings.clear()
 		self.region = ''
 		self.region_dict = {}
 		self.last_event = ()
-		self.resetHourlyTrend()
+		# Minute/hour/day counts by origin time, these outlive clear() and midnight
+		self.rollups = RollupEngine()
+		# Off while the journal replays events the saved rollups already counted
+		self.countRollups = True
 		self.dbFileName = ''
 		self.dbFile = None
 		self.events = self.EQEventQueue  # Alias for easier access
+		self.dedupIndex = DedupIndex()
+		# Lon/lat grid of the stored events by sequence number, for geographic queries
+		self.spatialIndex = SpatialIndex()
+		# (source event id, origin time in seconds) for each queue entry, same order as the queue
+		self.EQEventMeta = deque()
+		# Source event id -> insertion sequence number, the queue position is seqHead - 1 - seq
+		self.eventIDs = {}
+		# Source event id -> name of the source that reported it, for the dedup index and the journal
+		self.eventSources = {}
+		self.seqHead = 0
+		# Latest origin time of the stored events in epoch seconds, the queue is in arrival order
+		self.newestTime = None
+		# Lazy max-heap of (-mag, -seq), stale entries are dropped when they reach the top
+		self.magHeap = []
+		# Crash-safe log of today's changes, opened by the live map only
+		self.journal = None
+		# Cached summaries of the saved daily files
+		self.dayIndex = DayIndex()
+		self.retention = retention if retention is not None else RetentionPolicy()
+		# Estimated memory held by the stored events
+		self.eventBytes = 0
+		# Bumped whenever stored events change other than by adding new ones or evicting old ones,
+		# so a renderer that only draws new events knows to start over
+		self.layoutGeneration = 0
+		# (lon, lat, mag) of the events evicted since the renderer last asked, see takeEvicted()
+		self.evictedMarkers = []
 
 	# Clear the database of events /save a copy
 	def clear(self):
 		self.EQEventQueue.clear()
 		self.EQElocations.clear()
-		#self.EQdailyTrend.clear()
+		self.topRegion = None
+		self.regionSince = 0
+		self.dedupIndex.clear()
+		self.spatialIndex.clear()
+		self.EQEventMeta.clear()
+		self.eventIDs.clear()
+		self.eventSources.clear()
+		self.seqHead = 0
+		self.newestTime = None
+		self.magHeap = []
+		self.eventBytes = 0
+		self.layoutGeneration += 1
+		self.evictedMarkers = []
 		return True
 
 	# Add an earthquake event
-	def addEvent(self, lon, lat, mag, alert, tsunami, location, event_time=None):
+	def addEvent(self, lon, lat, mag, alert, tsunami, location, event_time=None, event_id=None, depth=None, source=None):
 		# Ensure mag is a number
 		try:
 			mag_val = float(mag)
@@ -49,15 +233,437 @@ class EventDB:
 			return False
 		if mag_val <= 0:
 			return False
-		self.EQEventQueue.appendleft((lon, lat, mag, alert, tsunami, location))
-		self.EQElocations.append(location)
-		# Track hourly trend
-		if event_time is None:
-			event_time = datetime.now()
-		hour = event_time.hour
-		if not hasattr(self, 'hourlyevents'):
-			self.resetHourlyTrend()
-		self.hourlyevents[hour] += 1
+		if self.columnar:
+			# Match what the store hands back
+			mag_val = round(mag_val, 2)
+		# Already have this event from its source
+		if event_id is not None and event_id in self.eventIDs:
+			return False
+		eventTime = event_time.timestamp() if event_time is not None else None
+		if self.columnar:
+			self.EQEventQueue.appendEvent((lon, lat, mag, alert, tsunami, location), depth, eventTime)
+		else:
+			self.EQEventQueue.appendleft((lon, lat, mag, alert, tsunami, location))
+		self.EQEventMeta.appendleft((event_id, eventTime))
+		if eventTime is not None and (self.newestTime is None or eventTime > self.newestTime):
+			self.newestTime = eventTime
+		if event_id is not None:
+			self.eventIDs[event_id] = self.seqHead
+			if source:
+				self.eventSources[event_id] = source
+		heapq.heappush(self.magHeap, (-mag_val, -self.seqHead))
+		self.spatialIndex.add(self.seqHead, lon, lat, eventTime)
+		self.seqHead += 1
+		self._countRegion(location, 1)
+		self._indexEvent(lon, lat, mag_val, eventTime, source)
+		self.eventBytes += eventBytes(self.EQEventQueue[0])
+		# Track trend by origin time
+		if self.countRollups:
+			self.rollups.add(eventTime if eventTime is not None else time.time())
+		if self.journal is not None:
+			self.journal.append(['a', event_id, lon, lat, mag, alert, tsunami, location, eventTime, depth, source])
+		self._enforceRetention()
+		return True
+
+	# Change the retention limits and apply them right away
+	def setRetention(self, windowS=RETENTION_WINDOW_S, maxEvents=RETENTION_MAX_EVENTS, maxBytes=RETENTION_MAX_BYTES):
+		self.retention = RetentionPolicy(windowS, maxEvents, maxBytes)
+		return self._enforceRetention()
+
+	# Evict the oldest events while the policy says so, returns how many went
+	def _enforceRetention(self):
+		evicted = 0
+		now = time.time()
+		while self.EQEventMeta and self.retention.shouldEvict(len(self.EQEventQueue), self.eventBytes,
+				self.EQEventMeta[-1][1], now):
+			self._evictOldest()
+			evicted += 1
+		# Evicted events leave stale heap entries behind, drop them before they add up
+		if len(self.magHeap) > 2 * len(self.EQEventQueue) + 64:
+			self._rebuildMagHeap()
+		return evicted
+
+	# Drop the oldest event from the queue and every index, other queue positions do not move
+	def _evictOldest(self):
+		event = self.EQEventQueue.pop()
+		eventID, eventTime = self.EQEventMeta.pop()
+		seq = self.seqHead - 1 - len(self.EQEventQueue)
+		source = None
+		if eventID is not None and self.eventIDs.get(eventID) == seq:
+			del self.eventIDs[eventID]
+			source = self.eventSources.pop(eventID, None)
+		self._unindexEvent(event, eventTime, source)
+		self.spatialIndex.remove(seq)
+		if seq >= self.regionSince:
+			self._countRegion(event[5], -1)
+		self.eventBytes -= eventBytes(event)
+		if eventTime is not None and eventTime == self.newestTime:
+			self._findNewestTime()
+		# The evicted marker is still drawn wherever events were plotted, the renderer clears it
+		if len(self.evictedMarkers) < EVICTED_MARKERS_MAX:
+			self.evictedMarkers.append((event[0], event[1], event[2]))
+		else:
+			self.evictedMarkers = []
+			self.layoutGeneration += 1
+
+	# Markers of the events evicted since the last call, for a renderer that only draws new events
+	def takeEvicted(self):
+		evicted = self.evictedMarkers
+		self.evictedMarkers = []
+		return evicted
+
+	# Bulk insert EQEvent records (oldest first), skipping events already seen and duplicates from other sources
+	# Events go in front of the ones already stored, call sortByTime() once a bulk load of older history is done
+	# Returns the number of events added
+	def addEvents(self, events):
+		added = 0
+		for event in sorted(events, key=lambda event: event.time or 0):
+			if event.id in self.eventIDs or event.status == 'deleted':
+				continue
+			eventTime = datetime.fromtimestamp(event.time / 1000) if event.time else None
+			if self.checkDupLonLat(event.lon, event.lat, event.mag, eventTime, source=event.source):
+				continue
+			if self.addEvent(event.lon, event.lat, event.mag, event.alert, event.tsunami, event.place,
+					event_time=eventTime, event_id=event.id, depth=event.depth, source=event.source):
+				added += 1
+		self.flushJournal()
+		return added
+
+	# Put the queue in newest-first origin time order, after a load of history older than the events
+	# already stored, e.g. the startup backfill. Live batches stay in arrival order, so a late arrival
+	# costs no more than any other event. Events without an origin time count as the oldest
+	# Returns True if anything moved, retention is applied again if so
+	def sortByTime(self):
+		times = [eventTime if eventTime is not None else -math.inf for eventID, eventTime in self.EQEventMeta]
+		if all(times[position] >= times[position + 1] for position in range(len(times) - 1)):
+			return False
+		# Stable, so events with the same time keep their order
+		order = sorted(range(len(times)), key=lambda position: -times[position])
+		if self.columnar:
+			self.EQEventQueue.reorder(order)
+		else:
+			events = list(self.EQEventQueue)
+			self.EQEventQueue = deque(events[position] for position in order)
+			self.events = self.EQEventQueue
+		meta = list(self.EQEventMeta)
+		self.EQEventMeta = deque(meta[position] for position in order)
+		self._renumberEvents()
+		self.layoutGeneration += 1
+		self._enforceRetention()
+		return True
+
+	# Open today's journal, replaying it over whatever load_today() found
+	# Returns the number of records replayed
+	def openJournal(self, day=None):
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = None
+		if day is None:
+			day = datetime.now()
+		if self.rollups.fileName is None:
+			self.rollups.load()
+		journal = EventJournal("EQMjournal" + day.strftime("%Y%m%d") + ".log")
+		records = journal.read()
+		if records:
+			# The journal has origin times and ids the day file lacks, so it wins
+			self._replayJournal(journal, records)
+		self.journal = journal
+		if not records and len(self.EQEventQueue) > 0:
+			# Start from what the day file held so a crash does not lose it
+			journal.compact(self._checkpointRecords())
+		self.rollups.save(self._journalMark())
+		return len(records)
+
+	# Rebuild the events from journal records
+	# Records up to the rollups' saved mark are counted already, only the rest are counted
+	def _replayJournal(self, journal, records):
+		self.clear()
+		counted = self.rollups.countedRecords(journal.fileName)
+		try:
+			for index, record in enumerate(records):
+				self.countRollups = index >= counted
+				self._applyJournalRecord(record)
+		finally:
+			self.countRollups = True
+		# A backfill journaled after newer live events replays out of order
+		self.sortByTime()
+
+	# File the journals of earlier days in their day files and delete them, for a day that ended
+	# while the map was not running, e.g. a power cut before midnight and a restart after it
+	# Call before openJournal(). Returns the number of journals recovered
+	def recoverJournals(self, today=None):
+		today = (today or datetime.now()).strftime("%Y%m%d")
+		if self.rollups.fileName is None:
+			self.rollups.load()
+		recovered = 0
+		for fileName in sorted(glob.glob("EQMjournal*.log")):
+			day = fileName[len("EQMjournal"):-len(".log")]
+			if len(day) != 8 or not day.isdigit() or day >= today:
+				continue
+			try:
+				saveDate = datetime.strptime(day, "%Y%m%d")
+				journal = EventJournal(fileName)
+				records = journal.read()
+				# A scratch DB so the live one is untouched, counting into the shared rollups
+				scratch = EventDB(columnar=self.columnar, retention=self.retention)
+				scratch.rollups = self.rollups
+				scratch.dayIndex = self.dayIndex
+				if records:
+					scratch._replayJournal(journal, records)
+				# The counts include the whole journal before it goes, a crash from here on replays nothing twice
+				self.rollups.save([journal.fileName, journal.records])
+				if records:
+					scratch.save(save_date=saveDate)
+				journal.remove()
+			except (OSError, ValueError) as e:
+				print("Journal:", fileName, "not recovered:", e)
+				continue
+			print("Journal:", fileName, "filed", scratch.numberOfEvents(), "events")
+			recovered += 1
+		return recovered
+
+	# Journal file and durable record count the rollups are in step with
+	def _journalMark(self):
+		return [self.journal.fileName, self.journal.records]
+
+	# Replay one journal record, without journaling it again
+	def _applyJournalRecord(self, record):
+		try:
+			kind, event_id = record[0], record[1]
+			if kind == 'd':
+				self.deleteEvent(event_id)
+				return
+			lon, lat, mag, alert, tsunami, location, eventTime = record[2:9]
+			event_time = datetime.fromtimestamp(eventTime) if eventTime is not None else None
+			if kind == 'a':
+				self.addEvent(lon, lat, mag, alert, tsunami, location, event_time=event_time, event_id=event_id,
+					depth=record[9] if len(record) > 9 else None, source=record[10] if len(record) > 10 else None)
+			elif kind == 'u':
+				self.updateEvent(event_id, lon, lat, mag, alert, tsunami, location, event_time=event_time)
+		except (IndexError, TypeError, ValueError, OverflowError, OSError):
+			return
+
+	# Add records that rebuild the live events, oldest first
+	def _checkpointRecords(self):
+		records = []
+		for position in range(len(self.EQEventQueue) - 1, -1, -1):
+			lon, lat, mag, alert, tsunami, location = self.EQEventQueue[position]
+			eventID, eventTime = self.EQEventMeta[position]
+			depth = self.EQEventQueue.getDepth(position) if self.columnar else None
+			records.append(['a', eventID, lon, lat, mag, alert, tsunami, location, eventTime, depth,
+				self.eventSources.get(eventID)])
+		return records
+
+	# Make the journaled changes durable, compacting once superseded records pile up
+	def flushJournal(self):
+		if self.journal is None:
+			return 0
+		try:
+			# Rollups are saved only after the records they count are durable, with the record
+			# count they include, so a crash in between is repaired by the replay in openJournal()
+			count = self.journal.flush()
+			self.rollups.save(self._journalMark())
+			if self.journal.records > len(self.EQEventQueue) + JOURNAL_COMPACT_SLACK:
+				# A crash before the next save leaves a mark past the shorter checkpoint, which is right
+				# as every checkpointed event was counted by the save above
+				self.journal.compact(self._checkpointRecords())
+				self.rollups.save(self._journalMark())
+		except OSError as e:
+			# Keep the pending records and try again on the next batch
+			print("Event journal write failed:", e)
+			return 0
+		return count
+
+	# Start a new day's journal once the old day is in its daily file
+	def rollJournal(self, day=None):
+		if self.journal is not None:
+			self.journal.remove()
+			self.journal = None
+		return self.openJournal(day)
+
+	# True if the source event id is already in the DB
+	def hasEvent(self, event_id):
+		return event_id in self.eventIDs
+
+	# Queue position of a source event id, or None
+	def _eventPosition(self, event_id):
+		seq = self.eventIDs.get(event_id)
+		if seq is None:
+			return None
+		return self.seqHead - 1 - seq
+
+	# Apply a revision of a stored event in place
+	# Returns True if anything shown on the map changed
+	def updateEvent(self, event_id, lon, lat, mag, alert, tsunami, location, event_time=None):
+		position = self._eventPosition(event_id)
+		if position is None:
+			return False
+		try:
+			mag_val = float(mag)
+		except (ValueError, TypeError):
+			return False
+		old = self.EQEventQueue[position]
+		oldTime = self.EQEventMeta[position][1]
+		eventTime = event_time.timestamp() if event_time is not None else oldTime
+		new = (lon, lat, mag, alert, tsunami, location)
+		if new == old and eventTime == oldTime:
+			return False
+		self.EQEventQueue[position] = new
+		self.EQEventMeta[position] = (event_id, eventTime)
+		if oldTime is not None and oldTime == self.newestTime:
+			self._findNewestTime()
+		elif eventTime is not None and (self.newestTime is None or eventTime > self.newestTime):
+			self.newestTime = eventTime
+		if self.columnar:
+			self.EQEventQueue.setTime(position, eventTime)
+		if new != old:
+			self.layoutGeneration += 1
+		if self.countRollups:
+			self.rollups.move(oldTime, eventTime)
+		if self.journal is not None:
+			self.journal.append(['u', event_id, lon, lat, mag, alert, tsunami, location, eventTime])
+		source = self.eventSources.get(event_id)
+		self._unindexEvent(old, oldTime, source)
+		self._indexEvent(lon, lat, mag_val, eventTime, source)
+		self.spatialIndex.add(self.seqHead - 1 - position, lon, lat, eventTime)
+		heapq.heappush(self.magHeap, (-mag_val, -(self.seqHead - 1 - position)))
+		if location != old[5]:
+			if self.seqHead - 1 - position >= self.regionSince:
+				self._countRegion(old[5], -1)
+				self._countRegion(location, 1)
+			self.eventBytes += eventBytes(new) - eventBytes(old)
+		return new != old
+
+	# Remove a retracted event
+	# Deletes are rare, so the sequence numbers are renumbered rather than tracking gaps
+	def deleteEvent(self, event_id):
+		position = self._eventPosition(event_id)
+		if position is None:
+			return False
+		old = self.EQEventQueue[position]
+		oldTime = self.EQEventMeta[position][1]
+		del self.EQEventQueue[position]
+		del self.EQEventMeta[position]
+		self._unindexEvent(old, oldTime, self.eventSources.pop(event_id, None))
+		if oldTime is not None and oldTime == self.newestTime:
+			self._findNewestTime()
+		if self.seqHead - 1 - position >= self.regionSince:
+			self._countRegion(old[5], -1)
+		self.eventBytes -= eventBytes(old)
+		if self.countRollups:
+			self.rollups.add(oldTime, -1)
+		self._renumberEvents()
+		self.layoutGeneration += 1
+		if self.journal is not None:
+			self.journal.append(['d', event_id])
+		return True
+
+	# Reassign sequence numbers so queue positions follow from them again
+	def _renumberEvents(self):
+		self.eventIDs.clear()
+		# Keep the newer events in the location count
+		self.regionSince = max(0, self.regionSince - (self.seqHead - len(self.EQEventMeta)))
+		self.seqHead = len(self.EQEventMeta)
+		for position, (eventID, eventTime) in enumerate(self.EQEventMeta):
+			if eventID is not None:
+				self.eventIDs[eventID] = self.seqHead - 1 - position
+		self._rebuildMagHeap()
+		self.spatialIndex.clear()
+		for position, event in enumerate(self.EQEventQueue):
+			self.spatialIndex.add(self.seqHead - 1 - position, event[0], event[1], self.EQEventMeta[position][1])
+
+	# Latest stored origin time, looked for again when the event holding it went or changed
+	def _findNewestTime(self):
+		times = [eventTime for eventID, eventTime in self.EQEventMeta if eventTime is not None]
+		self.newestTime = max(times) if times else None
+
+	# True if no stored event has a later origin time
+	def isNewestEvent(self, event_id):
+		position = self._eventPosition(event_id)
+		if position is None:
+			return False
+		eventTime = self.EQEventMeta[position][1]
+		return eventTime is not None and eventTime == self.newestTime
+
+	# Heap entries name events by sequence number, so rebuild it whenever those change
+	def _rebuildMagHeap(self):
+		self.magHeap = []
+		for position, event in enumerate(self.EQEventQueue):
+			try:
+				self.magHeap.append((-float(event[2]), -(self.seqHead - 1 - position)))
+			except (ValueError, TypeError, IndexError):
+				continue
+		heapq.heapify(self.magHeap)
+
+	# Adjust the running location count, keeping track of the most common one
+	def _countRegion(self, location, delta):
+		count = self.EQElocations[location] + delta
+		if count > 0:
+			self.EQElocations[location] = count
+		else:
+			self.EQElocations.pop(location, None)
+		if delta > 0:
+			if self.topRegion is None or count > self.EQElocations.get(self.topRegion, 0):
+				self.topRegion = location
+		elif location == self.topRegion:
+			# Only revisions and deletes get here, a full recount is fine
+			common = self.EQElocations.most_common(1)
+			self.topRegion = common[0][0] if common else None
+
+	# Register an event in the lookup indexes
+	# Positions are rounded the way the columnar store hands them back, so removal finds the entry
+	def _indexEvent(self, lon, lat, mag, eventTime, source=None):
+		try:
+			self.dedupIndex.add(round(float(lon), 4), round(float(lat), 4), mag, eventTime, source)
+		except (ValueError, TypeError):
+			pass
+
+	# Drop an event from the lookup indexes
+	def _unindexEvent(self, event, eventTime, source=None):
+		try:
+			self.dedupIndex.remove(round(float(event[0]), 4), round(float(event[1]), 4), float(event[2]), eventTime,
+				source)
+		except (ValueError, TypeError, IndexError):
+			pass
+
+	# Rebuild the lookup indexes after the queue was replaced by a load
+	# Day files converted from old pickles hold no source ids or origin times, so their events match on position only
+	def _rebuildIndexes(self, meta=None):
+		if self.columnar and not isinstance(self.EQEventQueue, ColumnarEventStore):
+			self.EQEventQueue = ColumnarEventStore(self.EQEventQueue)
+		self.events = self.EQEventQueue
+		self.dedupIndex.clear()
+		# Day files do not keep the source
+		self.eventSources.clear()
+		if meta is None:
+			meta = [(None, None)] * len(self.EQEventQueue)
+		self.EQEventMeta = deque(meta)
+		if self.columnar:
+			for position, (eventID, eventTime) in enumerate(meta):
+				self.EQEventQueue.setTime(position, eventTime)
+		for event, (eventID, eventTime) in zip(self.EQEventQueue, meta):
+			try:
+				self._indexEvent(event[0], event[1], float(event[2]), eventTime)
+			except (ValueError, TypeError, IndexError):
+				continue
+		self.eventBytes = sum(eventBytes(event) for event in self.EQEventQueue)
+		self._findNewestTime()
+		self._renumberEvents()
+		# Loaded events are not in the location count
+		self.regionSince = self.seqHead
+		self.layoutGeneration += 1
+		self._enforceRetention()
+
+	# Read an open day file into the queue
+	# Raises ValueError for anything else, old pickled files are never loaded
+	def _readDayFile(self, dbFile):
+		if not isDayFile(dbFile):
+			raise notDayFileError(getattr(dbFile, 'name', 'day file'))
+		with DayFile(dbFile) as day:
+			# Columns are filled straight from the mapped records, the deque needs a tuple per event
+			self.EQEventQueue = ColumnarEventStore.fromDayFile(day) if self.columnar else deque(day)
+			meta = day.meta()
+		self._rebuildIndexes(meta)
 
 	def checkForVolcanoAlert(self):
 		"""
@@ -81,83 +687,101 @@ class EventDB:
 	def getEvent(self, index):
 		return self.EQEventQueue[index]
 	
-	def resetHourlyTrend(self):
-		self.hourlyevents = [0] * 24
-
+	# Events per hour of origin time today, 24 values
 	def getDayTrend(self):
-		if hasattr(self, 'hourlyevents'):
-			return self.hourlyevents
-		return [0]*24
+		return self.rollups.hourSeries()
 	
 	def getEQdailyTrend(self):
-		# Return the daily trend of earthquake counts, which is a list of counts for each day
-		try:
-			if self.EQdailyTrend:
-				return self.EQdailyTrend
-			return "No Data"
-		except Exception as e:
-			return "No Data"
+		# Return the daily trend of earthquake counts, a week of counts ending yesterday
+		trend = self.rollups.daySeries(7, datetime.now() - timedelta(days=1))
+		if any(trend):
+			return trend
+		return "No Data"
 
 	# Retrieve largest event related data
 	def getLargestEvent(self):
-		EQlargest = deque()
-		max_value = None
-		max_location = ''
-		eventTrend = ''
-		# Spin off a table of the events and find the max
-		for event in self.EQEventQueue:
-			try:
-				EQlargest.append(float(event[2]))
-			except (ValueError, TypeError):
-				continue
-		if not EQlargest:
+		# Drop heap entries for events that were revised, deleted or evicted since they were pushed
+		while self.magHeap:
+			negMag, negSeq = self.magHeap[0]
+			position = self.seqHead - 1 + negSeq
+			if 0 <= position < len(self.EQEventQueue):
+				try:
+					if float(self.EQEventQueue[position][2]) == -negMag:
+						break
+				except (ValueError, TypeError, IndexError):
+					pass
+			heapq.heappop(self.magHeap)
+		if not self.magHeap:
 			return (None, '', None)
-		max_value = max(EQlargest)
-		# Find max item name
-		for event in self.EQEventQueue:
-			try:
-				if float(event[2]) == max_value:
-					max_location = event[5]
-					break
-			except (ValueError, TypeError):
-				continue
+		negMag, negSeq = self.magHeap[0]
+		max_value = -negMag
+		max_location = self.EQEventQueue[self.seqHead - 1 + negSeq][5]
 		# Trending - this is dumb not sure its useful?
+		eventTrend = ''
 		try:
-			if len(EQlargest) > 1:
-				if EQlargest[0] > EQlargest[1]:
+			if len(self.EQEventQueue) > 1:
+				newest = float(self.EQEventQueue[0][2])
+				previous = float(self.EQEventQueue[1][2])
+				if newest > previous:
 					eventTrend = " mag. increasing"
-				elif EQlargest[0] < EQlargest[1]:
+				elif newest < previous:
 					eventTrend = " mag. decreasing"
-				else:
-					eventTrend = ''
-		except Exception:
+		except (ValueError, TypeError, IndexError):
 			eventTrend = ''
 		return (max_value, eventTrend, max_location)
 
 	# Report the most active region since last poll
 	def getActiveRegion(self,preserve=False):
-		self.region = ''
+		self.region_dict = self.EQElocations
+		self.region = self.topRegion if self.topRegion is not None else []
 
-		self.region_dict = Counter(self.EQElocations)
-		self.region = self.region_dict.most_common(1)
+		if preserve == False:
+			# clear this table so its not out of control, USGS recall can get it by the hour
+			self.EQElocations = Counter()
+			self.topRegion = None
+			self.regionSince = self.seqHead
 
-		if preserve == False:self.EQElocations = [] # clear this table so its not out of control, USGS recall can get it by the hour
+		return self.region #returns the first in list
 
-		if self.region:
-			self.region = self.region[(0)]
-			self.region = self.region[0]
-		else:
-			pass
+	# Events inside a lon/lat box, latest added first; minLon > maxLon crosses the date line
+	# since is a datetime, events with no origin time are left out when it is given
+	def query_bbox(self, minLon, minLat, maxLon, maxLat, since=None):
+		seqs = self.spatialIndex.bbox(minLon, minLat, maxLon, maxLat, self._sinceSeconds(since))
+		return [self.EQEventQueue[self.seqHead - 1 - seq] for seq in sorted(seqs, reverse=True)]
+
+	# (distance km, event) within radiusKm of a point, nearest first
+	def query_radius(self, lon, lat, radiusKm, since=None):
+		matches = self.spatialIndex.radius(lon, lat, radiusKm, self._sinceSeconds(since))
+		return [(distance, self.EQEventQueue[self.seqHead - 1 - seq]) for distance, seq in matches]
+
+	# The count (distance km, event) closest to a point, nearest first
+	def nearest(self, lon, lat, count=1, since=None):
+		matches = self.spatialIndex.nearest(lon, lat, count, self._sinceSeconds(since))
+		return [(distance, self.EQEventQueue[self.seqHead - 1 - seq]) for distance, seq in matches]
+
+	def _sinceSeconds(self, since):
+		if since is None:
+			return None
+		if isinstance(since, datetime):
+			return since.timestamp()
+		return float(since)
+
+	# Guess if event is duplicated, by a stored event from another source close in position, origin time and magnitude
+	# Without an origin time only the newest event is compared, by position
+	def checkDupLonLat(self, lon, lat, mag=None, event_time=None, source=None):
+		try:
+			new_lon = float(lon)
+			new_lat = float(lat)
+			new_mag = float(mag) if mag is not None else None
+		except (ValueError, TypeError):
+			return False
 
-		return self.region #returns the first in list
+		if event_time is not None:
+			return self.dedupIndex.isDuplicate(new_lon, new_lat, new_mag, event_time.timestamp(), source)
 
-	# Guess if event is duplicated with lat,lon dups
-	def checkDupLonLat(self, lon, lat):
 		if self.EQEventQueue:
 			self.last_event = self.EQEventQueue[0]
 			try:
-				new_lon = float(lon)
-				new_lat = float(lat)
 				last_lon = float(self.last_event[0])
 				last_lat = float(self.last_event[1])
 			except (ValueError, TypeError, IndexError):
@@ -181,12 +805,20 @@ class EventDB:
 		if days < 1:
 			return []
 
-		counts = []
+		counts = [stats['count'] for stats in self.getRecentDailyStats(days, include_today)]
+		return counts[-days:]
+
+	# Retrieve recent per-day summaries (count, maxMag, topRegion) from the day index plus current day.
+	def getRecentDailyStats(self, days=7, include_today=True):
+		if days < 1:
+			return []
+
+		stats = []
 		filenames = []
 
 		# Prefer ramdisk, then local files.
-		for path in ("/run/shm/EQMdatabase*.dat", "EQMdatabase*.dat"):
-			files = sorted(glob.glob(path))
+		for path in (RAMDISK_DIR + "EQMdatabase*.dat", "EQMdatabase*.dat"):
+			files = self.dayIndex.files(path)
 			if files:
 				filenames = files
 				break
@@ -195,18 +827,15 @@ class EventDB:
 		file_days = max(0, days - (1 if include_today else 0))
 		if file_days > 0 and filenames:
 			for filename in filenames[-file_days:]:
-				try:
-					with open(filename, "rb") as db_file:
-						events = pickle.load(db_file)
-						counts.append(len(events))
-				except Exception:
-					# Skip unreadable/corrupt history files.
-					continue
+				entry = self.dayIndex.get(filename)
+				if entry is not None:
+					stats.append(entry)
 
 		if include_today:
-			counts.append(len(self.EQEventQueue))
+			stats.append({'count': len(self.EQEventQueue), 'maxMag': self.getLargestEvent()[0],
+				'topRegion': self.topRegion})
 
-		return counts[-days:]
+		return stats[-days:]
 
 	# Save the settings local path
 	def saveSettings(self):
@@ -229,15 +858,8 @@ class EventDB:
 
 	# Save the database to local path by default at 0:00
 	def save(self, save_date=None):
-		#this only works with default save of once a day - daily event trending
-		try:
-			if len(self.EQEventQueue) > 0:
-				self.EQdailyTrend.append(len(self.EQEventQueue))
-		except:
-			self.EQdailyTrend.append(0)
-
-		# reset the hourly trend
-		self.resetHourlyTrend()
+		# Daily and hourly trends live in the rollups, saved along with the journal
+		self.flushJournal()
 
 		# save
 		currentRTC = datetime.now()
@@ -247,14 +869,17 @@ class EventDB:
 			eventLogTime = save_date.strftime("%Y%m%d")
 
 		try:
-			self.dbFileName = "/run/shm/" + "EQMdatabase" + eventLogTime + ".dat"
+			self.dbFileName = RAMDISK_DIR + "EQMdatabase" + eventLogTime + ".dat"
 			self.dbFile = open(self.dbFileName, "wb")
 		except:
 			self.dbFileName = "EQMdatabase" + eventLogTime + ".dat"
 			self.dbFile = open(self.dbFileName, "wb")
 
-		pickle.dump(self.EQEventQueue, self.dbFile)
+		depths = self.EQEventQueue.column('depth') if self.columnar else None
+		writeDayFile(self.dbFile, self.EQEventQueue, self.EQEventMeta, depths)
 		self.dbFile.close()
+		# Index the header now so the trend never has to open the file
+		self.dayIndex.get(self.dbFileName)
 		return True
 
 	def load_today(self):
@@ -262,14 +887,17 @@ class EventDB:
 		self.EQEventQueue.clear()
 		currentRTC = datetime.now()
 		eventLogTime = currentRTC.strftime("%Y%m%d")
-		paths = ["/run/shm/EQMdatabase" + eventLogTime + ".dat", "EQMdatabase" + eventLogTime + ".dat"]
+		paths = [RAMDISK_DIR + "EQMdatabase" + eventLogTime + ".dat", "EQMdatabase" + eventLogTime + ".dat"]
 		for path in paths:
 			try:
 				with open(path, "rb") as db_file:
-					self.EQEventQueue = pickle.load(db_file)
+					self._readDayFile(db_file)
 					return self.EQEventQueue, 1
 			except FileNotFoundError:
 				continue
+			except ValueError as e:
+				print("DB:", e)
+				break
 			except Exception:
 				break
 		return self.EQEventQueue, 0
@@ -282,7 +910,7 @@ class EventDB:
 		# then look for files, and load the filename list aka file per day
 		# file variable will load a different day in the list
 		try:
-			path = "/run/shm/EQMdatabase*.dat"
+			path = RAMDISK_DIR + "EQMdatabase*.dat"
 			filenames = sorted(glob.glob(path))
 			filename = (filenames[file])
 			print("DB:", file, filename)
@@ -301,8 +929,10 @@ class EventDB:
 				print("DB:", file, filename)
 				self.dbFile = open(filename, "rb")
 
-		self.EQEventQueue = pickle.load(self.dbFile)
-		self.dbFile.close()
+		try:
+			self._readDayFile(self.dbFile)
+		finally:
+			self.dbFile.close()
 		return self.EQEventQueue, len(filenames)
 
 # Create instance of database
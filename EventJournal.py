@@ -0,0 +1,107 @@
+"""
+This code keeps a crash-safe journal of the day's event changes
+Each add, revision or delete is appended as one length-prefixed, crc-checked JSON record
+and fsync'd once per ingest batch, so a power cut loses at most the batch in flight.
+On startup the journal is replayed to rebuild the day; a torn record at the tail is cut
+off. When superseded records pile up the journal is rewritten as a checkpoint of the live
+events (written to a temp file and renamed into place).
+"""
+import json
+import os
+import struct
+import zlib
+
+# Record header: payload length, crc32 of the payload
+HEADER = struct.Struct('<II')
+# A payload bigger than this is a corrupt length, not a real record
+MAX_RECORD_BYTES = 1 << 20
+
+class EventJournal:
+
+	# Class Constructor
+	def __init__(self, fileName):
+		self.fileName = fileName
+		self.file = None
+		self.pending = []
+		# Records in the file, to decide when compaction pays off
+		self.records = 0
+
+	# Read every intact record, cutting off a torn or corrupt tail
+	def read(self):
+		records = []
+		goodOffset = 0
+		try:
+			with open(self.fileName, "rb") as journalFile:
+				data = journalFile.read()
+		except FileNotFoundError:
+			return records
+		offset = 0
+		while offset + HEADER.size <= len(data):
+			length, crc = HEADER.unpack_from(data, offset)
+			start = offset + HEADER.size
+			if length > MAX_RECORD_BYTES or start + length > len(data):
+				break
+			payload = data[start:start + length]
+			if zlib.crc32(payload) != crc:
+				break
+			try:
+				records.append(json.loads(payload.decode('utf-8')))
+			except ValueError:
+				break
+			offset = start + length
+			goodOffset = offset
+		if goodOffset < len(data):
+			print("Journal:", self.fileName, "dropping", len(data) - goodOffset, "bytes of torn records")
+			with open(self.fileName, "r+b") as journalFile:
+				journalFile.truncate(goodOffset)
+		self.records = len(records)
+		return records
+
+	# Queue a record, written on the next flush
+	def append(self, record):
+		self.pending.append(encode(record))
+
+	# Write the queued records and make them durable
+	def flush(self):
+		if not self.pending:
+			return 0
+		if self.file is None:
+			self.file = open(self.fileName, "ab")
+		count = len(self.pending)
+		self.file.write(b''.join(self.pending))
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.pending = []
+		self.records += count
+		return count
+
+	# Replace the journal with a checkpoint of the given records
+	def compact(self, records):
+		self.close()
+		tempName = self.fileName + ".tmp"
+		with open(tempName, "wb") as tempFile:
+			for record in records:
+				tempFile.write(encode(record))
+			tempFile.flush()
+			os.fsync(tempFile.fileno())
+		os.replace(tempName, self.fileName)
+		self.records = len(records)
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	# Delete the journal once its day is saved in the daily file
+	def remove(self):
+		self.close()
+		self.pending = []
+		self.records = 0
+		try:
+			os.remove(self.fileName)
+		except FileNotFoundError:
+			pass
+
+def encode(record):
+	payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+	return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
@@ -0,0 +1,215 @@
+"""
+This code keeps the day's earthquake events as columns instead of a deque of tuples
+Positions, magnitude, depth, origin time and flags live in preallocated growable numpy
+arrays, strings in an interned table, so a month of backfill costs a few bytes per event
+and analytics or rendering can work on whole columns. It behaves like the newest-first
+deque EventDB used before, so getEvent() still returns the same 6-tuples.
+numpy is optional, without it EventDB stays on the deque.
+"""
+from DayFile import HEADER, RECORD
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+COLUMNAR_AVAILABLE = numpy is not None
+INITIAL_CAPACITY = 1024
+
+# Numpy view of one DayFile record, same layout as DayFile.RECORD
+if numpy is not None:
+	DAY_RECORD = numpy.dtype([('lon', '<f8'), ('lat', '<f8'), ('mag', '<f8'), ('depth', '<f8'), ('time', '<f8'),
+		('id', '<i4'), ('alert', '<i4'), ('tsunami', '<i4'), ('location', '<i4')])
+	assert DAY_RECORD.itemsize == RECORD.size
+
+# Newest first, like deque.appendleft; stored oldest first so both ends are O(1)
+class ColumnarEventStore:
+
+	# Class Constructor
+	def __init__(self, events=(), capacity=INITIAL_CAPACITY):
+		if numpy is None:
+			raise ImportError("ColumnarEventStore needs numpy")
+		self.capacity = max(16, capacity)
+		# Positions stay float64 so the rounded tuple view matches what was indexed
+		self.lon = numpy.zeros(self.capacity, dtype=numpy.float64)
+		self.lat = numpy.zeros(self.capacity, dtype=numpy.float64)
+		self.depth = numpy.zeros(self.capacity, dtype=numpy.float32)
+		self.mag = numpy.zeros(self.capacity, dtype=numpy.float32)
+		# Origin time in epoch seconds, NaN if unknown
+		self.time = numpy.zeros(self.capacity, dtype=numpy.float64)
+		self.tsunami = numpy.zeros(self.capacity, dtype=numpy.int8)
+		# Indexes into the interned string table
+		self.alert = numpy.zeros(self.capacity, dtype=numpy.int32)
+		self.location = numpy.zeros(self.capacity, dtype=numpy.int32)
+		self.strings = [None]
+		self.stringIDs = {None: 0}
+		# Live rows are start..end-1, oldest first
+		self.start = 0
+		self.end = 0
+		# Add the oldest first so the newest ends up at index 0
+		for event in reversed(list(events)):
+			self.appendleft(event)
+
+	# Store holding an open DayFile's events, the columns are filled straight from its mapped
+	# records with no tuple per event, and depth and origin time come along
+	@classmethod
+	def fromDayFile(cls, day):
+		count = len(day)
+		store = cls(capacity=max(INITIAL_CAPACITY, count))
+		if count == 0:
+			return store
+		# Newest first in the file, oldest first in the store
+		records = numpy.frombuffer(day.map, dtype=DAY_RECORD, count=count, offset=HEADER.size)[::-1]
+		for name in ('lon', 'lat', 'mag', 'depth', 'time'):
+			getattr(store, name)[:count] = records[name]
+		# Value table indexes become string table indexes
+		for name in ('alert', 'location'):
+			indexes = records[name]
+			strings = numpy.zeros(len(day.values), dtype=numpy.int32)
+			for index in numpy.unique(indexes):
+				strings[index] = store._intern(day.values[index])
+			getattr(store, name)[:count] = strings[indexes]
+		flags = numpy.zeros(len(day.values), dtype=numpy.int8)
+		for index in numpy.unique(records['tsunami']):
+			try:
+				flags[index] = int(day.values[index] or 0)
+			except (ValueError, TypeError):
+				flags[index] = 0
+		store.tsunami[:count] = flags[records['tsunami']]
+		store.end = count
+		# Release the mapped buffer so the day file can close
+		del records
+		return store
+
+	def _columns(self):
+		return (self.lon, self.lat, self.depth, self.mag, self.time, self.tsunami, self.alert, self.location)
+
+	def _intern(self, value):
+		index = self.stringIDs.get(value)
+		if index is None:
+			index = len(self.strings)
+			self.strings.append(value)
+			self.stringIDs[value] = index
+		return index
+
+	# Make room for one more row at the end, compacting before growing
+	def _reserve(self):
+		if self.end < self.capacity:
+			return
+		count = self.end - self.start
+		if self.start > self.capacity // 2:
+			for column in self._columns():
+				column[:count] = column[self.start:self.end]
+		else:
+			self.capacity *= 2
+			self.lon, self.lat, self.depth, self.mag, self.time, self.tsunami, self.alert, self.location = [
+				numpy.concatenate((column[self.start:self.end], numpy.zeros(self.capacity - count, dtype=column.dtype)))
+				for column in self._columns()]
+		self.start = 0
+		self.end = count
+
+	# Physical row of a newest-first index
+	def _row(self, index):
+		count = self.end - self.start
+		if index < 0:
+			index += count
+		if index < 0 or index >= count:
+			raise IndexError("event index out of range")
+		return self.end - 1 - index
+
+	def _write(self, row, event, depth=None, eventTime=None):
+		lon, lat, mag, alert, tsunami, location = event
+		self.lon[row] = toFloat(lon)
+		self.lat[row] = toFloat(lat)
+		self.mag[row] = toFloat(mag)
+		self.depth[row] = toFloat(depth)
+		self.time[row] = toFloat(eventTime)
+		try:
+			self.tsunami[row] = int(tsunami or 0)
+		except (ValueError, TypeError):
+			self.tsunami[row] = 0
+		self.alert[row] = self._intern(alert)
+		self.location[row] = self._intern(location)
+
+	# Add the newest event with the columns a 6-tuple does not carry
+	def appendEvent(self, event, depth=None, eventTime=None):
+		self._reserve()
+		self._write(self.end, event, depth, eventTime)
+		self.end += 1
+
+	def appendleft(self, event):
+		self.appendEvent(event)
+
+	# Remove and return the oldest event
+	def pop(self):
+		if self.end == self.start:
+			raise IndexError("pop from an empty store")
+		event = self[-1]
+		self.start += 1
+		return event
+
+	def clear(self):
+		self.start = 0
+		self.end = 0
+		self.strings = [None]
+		self.stringIDs = {None: 0}
+
+	# Origin time of an event in epoch seconds, or None
+	def getTime(self, index):
+		value = float(self.time[self._row(index)])
+		return None if value != value else value
+
+	# Depth of an event in km, or None
+	def getDepth(self, index):
+		value = float(self.depth[self._row(index)])
+		return None if value != value else value
+
+	def setTime(self, index, eventTime):
+		self.time[self._row(index)] = toFloat(eventTime)
+
+	# Newest-first view of one column, no copy
+	def column(self, name):
+		return getattr(self, name)[self.start:self.end][::-1]
+
+	def __len__(self):
+		return self.end - self.start
+
+	# Tuple view, rounded back to the precision the feeds report
+	def __getitem__(self, index):
+		row = self._row(index)
+		return (round(float(self.lon[row]), 4), round(float(self.lat[row]), 4), round(float(self.mag[row]), 2),
+			self.strings[self.alert[row]], int(self.tsunami[row]), self.strings[self.location[row]])
+
+	# Replace an event, keeping its depth and origin time
+	def __setitem__(self, index, event):
+		row = self._row(index)
+		self._write(row, event, self.depth[row], self.time[row])
+
+	# Deletes are rare, shift the older rows up by one
+	def __delitem__(self, index):
+		row = self._row(index)
+		for column in self._columns():
+			column[self.start + 1:row + 1] = column[self.start:row].copy()
+		self.start += 1
+
+	# Rearrange the events, order lists the current newest-first indexes in their new order
+	def reorder(self, order):
+		rows = numpy.array([self._row(index) for index in reversed(order)], dtype=numpy.int64)
+		for column in self._columns():
+			column[self.start:self.end] = column[rows]
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self[index]
+
+	def __bool__(self):
+		return self.end > self.start
+
+	def __repr__(self):
+		return "ColumnarEventStore(" + str(len(self)) + " events)"
+
+def toFloat(value):
+	try:
+		return float(value)
+	except (ValueError, TypeError):
+		return float('nan')
@@ -0,0 +1,59 @@
+"""
+This code provides one shared HTTP session for all of the event feeds
+Connections are pooled and kept alive between polls, and each feed URL remembers its
+ETag / Last-Modified validators so an unchanged feed costs a single 304 round trip
+"""
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+class FeedSession:
+
+	# Class Constructor
+	def __init__(self, poolSize=4):
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+		self.session.headers.update({'User-Agent': 'EQMap2', 'Accept-Encoding': 'gzip, deflate'})
+		# url -> (etag, last modified)
+		self.validators = {}
+		self.lock = threading.Lock()
+
+	# GET a feed, returns the response or None when the server reports it unchanged (304)
+	def get(self, url, timeout=10, stream=False):
+		headers = {}
+		with self.lock:
+			etag, lastModified = self.validators.get(url, (None, None))
+		if etag:
+			headers['If-None-Match'] = etag
+		if lastModified:
+			headers['If-Modified-Since'] = lastModified
+
+		r = self.session.get(url, headers=headers, timeout=timeout, stream=stream)
+		if r.status_code == 304:
+			r.close()
+			return None
+		r.raise_for_status()
+
+		# Remember the validators for the next poll of this url
+		etag = r.headers.get('ETag')
+		lastModified = r.headers.get('Last-Modified')
+		with self.lock:
+			if etag or lastModified:
+				self.validators[url] = (etag, lastModified)
+			else:
+				self.validators.pop(url, None)
+		return r
+
+	# Drop the validators for a url, used when a body could not be processed
+	# so the next poll downloads it again instead of getting a 304
+	def forget(self, url):
+		with self.lock:
+			self.validators.pop(url, None)
+
+	def close(self):
+		self.session.close()
+
+# Return a class instance
+feedSession = FeedSession()
@@ -0,0 +1,144 @@
+"""
+This code keeps event counts rolled up by origin time at minute, hour and day resolution
+Buckets are keyed on the event's own local origin time, so a late arrival, a revised
+origin time or a retraction corrects the bucket it belongs to. Counts are updated on
+every insert and saved beside the journal, so the trend graph and wash page read small
+precomputed series that survive a restart.
+Each save records how many journal records the counts include, so replaying the journal
+after a crash counts exactly the records saved after them.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+
+ROLLUP_FILE_NAME = "EQMrollups.json"
+
+# How far back each resolution is kept
+KEEP_MINUTES = timedelta(days=2)
+KEEP_HOURS = timedelta(days=31)
+KEEP_DAYS = timedelta(days=3 * 366)
+
+# Bucket keys are local time as plain numbers: YYYYMMDD, YYYYMMDDHH, YYYYMMDDHHMM
+def dayKey(when):
+	return when.year * 10000 + when.month * 100 + when.day
+
+def hourKey(when):
+	return dayKey(when) * 100 + when.hour
+
+def minuteKey(when):
+	return hourKey(when) * 100 + when.minute
+
+class RollupEngine:
+
+	# Class Constructor
+	def __init__(self):
+		self.minutes = {}
+		self.hours = {}
+		self.days = {}
+		self.fileName = None
+		self.dirty = False
+		self.prunedDay = None
+		# [journal file name, records] already in the counts
+		self.journalMark = None
+
+	def clear(self):
+		self.minutes.clear()
+		self.hours.clear()
+		self.days.clear()
+		self.dirty = True
+
+	# Count an event (delta=-1 to take one back) at its origin time in epoch seconds
+	def add(self, eventTime, delta=1):
+		if eventTime is None:
+			return False
+		try:
+			when = datetime.fromtimestamp(eventTime)
+		except (OverflowError, OSError, ValueError, TypeError):
+			return False
+		for buckets, key in ((self.minutes, minuteKey(when)), (self.hours, hourKey(when)), (self.days, dayKey(when))):
+			count = buckets.get(key, 0) + delta
+			if count > 0:
+				buckets[key] = count
+			else:
+				buckets.pop(key, None)
+		self.dirty = True
+		self._prune()
+		return True
+
+	# A revised origin time moves the event to its new buckets
+	def move(self, oldTime, newTime):
+		if oldTime == newTime:
+			return False
+		self.add(oldTime, -1)
+		return self.add(newTime, 1)
+
+	# Drop buckets past their resolution's history, once per day
+	def _prune(self, now=None):
+		now = now or datetime.now()
+		today = dayKey(now)
+		if self.prunedDay == today:
+			return
+		self.prunedDay = today
+		for buckets, keep, keyOf in ((self.minutes, KEEP_MINUTES, minuteKey), (self.hours, KEEP_HOURS, hourKey),
+				(self.days, KEEP_DAYS, dayKey)):
+			oldest = keyOf(now - keep)
+			for key in [key for key in buckets if key < oldest]:
+				del buckets[key]
+
+	# Events per hour of a day (default today), 24 values
+	def hourSeries(self, day=None):
+		base = dayKey(day or datetime.now()) * 100
+		return [self.hours.get(base + hour, 0) for hour in range(24)]
+
+	# Events per minute for the last count minutes, oldest first
+	def minuteSeries(self, count=60, end=None):
+		end = end or datetime.now()
+		return [self.minutes.get(minuteKey(end - timedelta(minutes=offset)), 0) for offset in range(count - 1, -1, -1)]
+
+	# Events per day for the count days ending on end (default today), oldest first
+	def daySeries(self, count=7, end=None):
+		end = end or datetime.now()
+		return [self.days.get(dayKey(end - timedelta(days=offset)), 0) for offset in range(count - 1, -1, -1)]
+
+	# Read saved rollups and keep saving to the same file
+	def load(self, fileName=ROLLUP_FILE_NAME):
+		self.fileName = fileName
+		try:
+			with open(fileName, "r") as rollupFile:
+				saved = json.load(rollupFile)
+			self.minutes = {int(key): count for key, count in saved.get('minutes', {}).items()}
+			self.hours = {int(key): count for key, count in saved.get('hours', {}).items()}
+			self.days = {int(key): count for key, count in saved.get('days', {}).items()}
+			self.journalMark = saved.get('journal')
+		except (OSError, ValueError, AttributeError, TypeError):
+			return False
+		self.dirty = False
+		self._prune()
+		return True
+
+	# How many records of a journal file the saved counts already include
+	def countedRecords(self, journalName):
+		try:
+			if self.journalMark[0] == journalName:
+				return int(self.journalMark[1])
+		except (TypeError, IndexError, ValueError):
+			pass
+		return 0
+
+	# Write the rollups if anything changed since the last save, journalMark is
+	# [journal file name, records] for a journal made durable before this save
+	def save(self, journalMark=None):
+		if journalMark is not None and journalMark != self.journalMark:
+			self.journalMark = journalMark
+			self.dirty = True
+		if self.fileName is None or not self.dirty:
+			return False
+		tempName = self.fileName + ".tmp"
+		with open(tempName, "w") as rollupFile:
+			json.dump({'minutes': self.minutes, 'hours': self.hours, 'days': self.days, 'journal': self.journalMark},
+				rollupFile)
+			rollupFile.flush()
+			os.fsync(rollupFile.fileno())
+		os.replace(tempName, self.fileName)
+		self.dirty = False
+		return True
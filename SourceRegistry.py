@@ -0,0 +1,76 @@
+"""
+This code keeps the registry of earthquake data sources
+A source is a small descriptor for any FDSN event service or GeoJSON summary feed; one
+generic gatherer and one parser serve all of them, so adding a regional network is one
+register() call, for example:
+
+	sourceRegistry.register(FeedSource('ingv', 'https://webservices.ingv.it/fdsnws/event/1/query',
+		kind='fdsn', queryFormat='geojson', priority=3))
+"""
+
+# kind='feed'  a fixed GeoJSON document re-read each poll (USGS summary feeds)
+# kind='fdsn'  an FDSN event query service polled incrementally with updatedafter= cursors
+class FeedSource:
+
+	# Class Constructor
+	def __init__(self, name, url, kind='fdsn', intervalMs=30000, priority=0, queryFormat='json',
+			limit=100, backfillUrl=None, timeout=10, enabled=True):
+		self.name = name
+		self.url = url
+		self.kind = kind
+		# Poll period, and ingest order when several sources report at once (higher first)
+		self.intervalMs = intervalMs
+		self.priority = priority
+		# FDSN format= value, 'json' for seismicportal, 'geojson' for USGS/INGV style servers
+		self.queryFormat = queryFormat
+		self.limit = limit
+		# Larger feed used for the startup backfill of 'feed' sources
+		self.backfillUrl = backfillUrl
+		# HTTP timeout in seconds for one request
+		self.timeout = timeout
+		self.enabled = enabled
+
+	def __repr__(self):
+		return "FeedSource(" + self.name + ", " + self.kind + ", " + self.url + ")"
+
+class SourceRegistry:
+
+	# Class Constructor
+	def __init__(self):
+		self.sources = {}
+
+	# Add or replace a source
+	def register(self, source):
+		self.sources[source.name] = source
+		return source
+
+	def unregister(self, name):
+		return self.sources.pop(name, None)
+
+	def get(self, name):
+		return self.sources.get(name)
+
+	def setEnabled(self, name, enabled=True):
+		source = self.sources.get(name)
+		if source is None:
+			return False
+		source.enabled = enabled
+		return True
+
+	# Enabled sources, highest priority first
+	def getSources(self):
+		sources = [source for source in self.sources.values() if source.enabled]
+		sources.sort(key=lambda source: -source.priority)
+		return sources
+
+# Default sources
+USGS_SOURCE = FeedSource('usgs', 'https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_hour.geojson',
+	kind='feed', priority=2,
+	backfillUrl='https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_day.geojson')
+EU_SOURCE = FeedSource('eu', 'https://www.seismicportal.eu/fdsnws/event/1/query',
+	kind='fdsn', priority=1, queryFormat='json')
+
+# Return a class instance
+sourceRegistry = SourceRegistry()
+sourceRegistry.register(USGS_SOURCE)
+sourceRegistry.register(EU_SOURCE)
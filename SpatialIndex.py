@@ -0,0 +1,171 @@
+"""
+This code keeps a spatial grid index of the stored earthquake events
+Events sit in fixed size lon/lat cells, so box, radius and nearest-event queries only
+visit the cells that can hold an answer instead of every event of the day.
+Entries are keyed by the caller's event key (EventDB uses its insertion sequence number).
+"""
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180.0
+SPATIAL_CELL_DEGREES = 1.0
+
+# Great circle distance in km
+def haversineKm(lon1, lat1, lon2, lat2):
+	dLat = math.radians(lat2 - lat1)
+	dLon = math.radians(lon2 - lon1)
+	a = math.sin(dLat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dLon / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class SpatialIndex:
+
+	# Class Constructor
+	def __init__(self, degrees=SPATIAL_CELL_DEGREES):
+		self.degrees = degrees
+		self.lonCells = int(math.ceil(360.0 / degrees))
+		self.latCells = int(math.ceil(180.0 / degrees))
+		# (lon cell, lat cell) -> {key: (lon, lat, origin time)}
+		self.cells = {}
+		# key -> cell, for removal
+		self.keys = {}
+
+	def clear(self):
+		self.cells.clear()
+		self.keys.clear()
+
+	def __len__(self):
+		return len(self.keys)
+
+	def _cell(self, lon, lat):
+		return (int(math.floor((lon + 180.0) / self.degrees)) % self.lonCells,
+			min(max(int(math.floor((lat + 90.0) / self.degrees)), 0), self.latCells - 1))
+
+	def add(self, key, lon, lat, eventTime=None):
+		try:
+			lon = float(lon)
+			lat = float(lat)
+		except (ValueError, TypeError):
+			return False
+		if self.keys.get(key) is not None:
+			self.remove(key)
+		cell = self._cell(lon, lat)
+		self.cells.setdefault(cell, {})[key] = (lon, lat, eventTime)
+		self.keys[key] = cell
+		return True
+
+	def remove(self, key):
+		cell = self.keys.pop(key, None)
+		if cell is None:
+			return False
+		entries = self.cells.get(cell)
+		if entries is not None:
+			entries.pop(key, None)
+			if not entries:
+				del self.cells[cell]
+		return True
+
+	# Entries of the cells covering a lat range and one or two lon cell ranges
+	def _scan(self, lonRanges, minLat, maxLat, since):
+		firstLat = self._cell(0.0, minLat)[1]
+		lastLat = self._cell(0.0, maxLat)[1]
+		for lonFirst, lonLast in lonRanges:
+			for lonCell in range(lonFirst, lonLast + 1):
+				for latCell in range(firstLat, lastLat + 1):
+					entries = self.cells.get((lonCell, latCell))
+					if not entries:
+						continue
+					for key, (lon, lat, eventTime) in entries.items():
+						if since is not None and (eventTime is None or eventTime < since):
+							continue
+						yield key, lon, lat
+
+	def _lonRanges(self, minLon, maxLon):
+		if maxLon - minLon >= 360.0:
+			return [(0, self.lonCells - 1)]
+		first = self._cell(minLon, 0.0)[0]
+		last = self._cell(maxLon, 0.0)[0]
+		if first <= last and minLon <= maxLon:
+			return [(first, last)]
+		# Crosses the date line
+		return [(first, self.lonCells - 1), (0, last)]
+
+	# Keys inside a box, minLon > maxLon crosses the date line
+	def bbox(self, minLon, minLat, maxLon, maxLat, since=None):
+		crosses = minLon > maxLon
+		result = []
+		for key, lon, lat in self._scan(self._lonRanges(minLon, maxLon), minLat, maxLat, since):
+			if lat < minLat or lat > maxLat:
+				continue
+			if crosses:
+				if lon < minLon and lon > maxLon:
+					continue
+			elif lon < minLon or lon > maxLon:
+				continue
+			result.append(key)
+		return result
+
+	# (km, key) within a radius, nearest first
+	def radius(self, lon, lat, radiusKm, since=None):
+		dLat = radiusKm / KM_PER_DEGREE
+		minLat = lat - dLat
+		maxLat = lat + dLat
+		if minLat <= -90.0 or maxLat >= 90.0:
+			lonRanges = [(0, self.lonCells - 1)]
+		else:
+			dLon = dLat / math.cos(math.radians(max(abs(minLat), abs(maxLat))))
+			lonRanges = self._lonRanges(lon - dLon, lon + dLon) if dLon < 180.0 else [(0, self.lonCells - 1)]
+		result = []
+		for key, otherLon, otherLat in self._scan(lonRanges, max(minLat, -90.0), min(maxLat, 90.0), since):
+			distance = haversineKm(lon, lat, otherLon, otherLat)
+			if distance <= radiusKm:
+				result.append((distance, key))
+		result.sort()
+		return result
+
+	# The count closest (km, key), nearest first
+	# Rings of cells are searched outward until count candidates turn up, then a radius
+	# query out to the farthest candidate catches anything closer in cells not yet seen
+	def nearest(self, lon, lat, count=1, since=None):
+		if count < 1 or not self.keys:
+			return []
+		lonCell, latCell = self._cell(lon, lat)
+		best = []
+		visited = set()
+		maxRing = max(self.lonCells // 2, self.latCells)
+		for ring in range(maxRing + 1):
+			for cell in self._ring(lonCell, latCell, ring):
+				if cell in visited:
+					continue
+				visited.add(cell)
+				entries = self.cells.get(cell)
+				if not entries:
+					continue
+				for key, (otherLon, otherLat, eventTime) in entries.items():
+					if since is not None and (eventTime is None or eventTime < since):
+						continue
+					distance = haversineKm(lon, lat, otherLon, otherLat)
+					if len(best) < count:
+						heapq.heappush(best, (-distance, key))
+					elif distance < -best[0][0]:
+						heapq.heapreplace(best, (-distance, key))
+			if len(best) >= count:
+				return self.radius(lon, lat, -best[0][0], since)[:count]
+		return sorted((-negDistance, key) for negDistance, key in best)
+
+	# Cells at Chebyshev distance ring from a cell, wrapping in longitude
+	def _ring(self, lonCell, latCell, ring):
+		if ring == 0:
+			return [(lonCell, latCell)]
+		cells = []
+		for dLat in range(-ring, ring + 1):
+			row = latCell + dLat
+			if row < 0 or row >= self.latCells:
+				continue
+			if abs(dLat) == ring:
+				steps = range(-ring, ring + 1)
+			else:
+				steps = (-ring, ring)
+			for dLon in steps:
+				cells.append(((lonCell + dLon) % self.lonCells, row))
+		return cells
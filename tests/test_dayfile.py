@@ -0,0 +1,58 @@
+import os
+import pickle
+import pytest
+from DayFile import DayFile, HEADER, RECORD, writeDayFile
+from DayIndex import DayIndex
+from EventDB import EventDB
+
+EVENTS = [(-150.0, 61.0, 3.1, None, 0, 'Alaska'), (12.0, 42.0, 2.5, 'green', 1, 'Central Italy')]
+META = [('ak1', 1700000600.0), ('eu1', 1700000000.0)]
+
+def openFiles():
+	return len(os.listdir('/proc/self/fd'))
+
+def writeDay(path):
+	with open(path, 'wb') as dbFile:
+		writeDayFile(dbFile, EVENTS, META, [10.0, 8.0])
+	with open(path, 'rb') as dbFile:
+		return dbFile.read()
+
+def test_day_file_round_trip(tmp_path):
+	path = str(tmp_path / 'EQMdatabase20240101.dat')
+	writeDay(path)
+	with DayFile(path) as day:
+		assert list(day) == EVENTS
+		assert day.meta() == META
+		assert day.depths() == [10.0, 8.0]
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason="needs /proc to count open files")
+def test_truncated_day_file_raises_and_closes(tmp_path):
+	path = str(tmp_path / 'EQMdatabase20240101.dat')
+	data = writeDay(path)
+	# Empty, inside the header, inside the records and inside the value table
+	for length in (0, HEADER.size // 2, HEADER.size + RECORD.size + 3, len(data) - 2):
+		with open(path, 'wb') as dbFile:
+			dbFile.write(data[:length])
+		before = openFiles()
+		with pytest.raises(ValueError):
+			DayFile(path)
+		assert openFiles() == before
+
+# Unpickling this runs code
+class Payload:
+
+	def __reduce__(self):
+		return (os.mkdir, (self.path,))
+
+def test_pickled_day_file_is_never_loaded(tmp_path):
+	path = str(tmp_path / 'EQMdatabase20240101.dat')
+	payload = Payload()
+	payload.path = str(tmp_path / 'unpickled')
+	with open(path, 'wb') as dbFile:
+		pickle.dump(payload, dbFile)
+
+	assert DayIndex().get(path) is None
+	with open(path, 'rb') as dbFile:
+		with pytest.raises(ValueError, match='python3 DayFile.py'):
+			EventDB()._readDayFile(dbFile)
+	assert not os.path.exists(payload.path)
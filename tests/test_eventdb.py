@@ -0,0 +1,63 @@
+from datetime import datetime
+from EventDB import EventDB, RetentionPolicy, EVICTED_MARKERS_MAX
+from EQEvent import EQEvent
+
+START_MS = 1700000000000
+
+def quake(eventID, offsetS, lon, lat, mag, source):
+	return EQEvent(eventID, START_MS + offsetS * 1000, lon, lat, 8.0, mag, None, 0, 'Swarm Valley', source)
+
+def test_same_source_swarm_is_kept():
+	db = EventDB()
+	# Six events 40 s and about 5 km apart from one network
+	swarm = [quake('nc%d' % index, 40 * index, -122.80 + 0.05 * index, 38.80, 2.1 + 0.05 * (index % 3), 'usgs')
+		for index in range(6)]
+	assert db.addEvents(swarm) == 6
+	assert db.numberOfEvents() == 6
+
+def test_cross_source_pair_is_one_event():
+	db = EventDB()
+	assert db.addEvents([quake('us1', 0, -122.80, 38.80, 4.2, 'usgs')]) == 1
+	# The same quake from the other network, a little off in time, place and magnitude
+	assert db.addEvents([quake('20231114_0001', 20, -122.75, 38.83, 4.4, 'eu')]) == 0
+	assert db.numberOfEvents() == 1
+	# A nearby aftershock from the first source is still its own event
+	assert db.addEvents([quake('us2', 60, -122.78, 38.81, 4.0, 'usgs')]) == 1
+	assert db.numberOfEvents() == 2
+
+def test_revised_event_keeps_its_source():
+	db = EventDB()
+	db.addEvents([quake('us1', 0, -122.80, 38.80, 4.2, 'usgs')])
+	db.updateEvent('us1', -122.79, 38.80, 4.3, None, 0, 'Swarm Valley')
+	originTime = datetime.fromtimestamp(START_MS / 1000)
+	assert not db.checkDupLonLat(-122.79, 38.80, 4.3, originTime, source='usgs')
+	assert db.checkDupLonLat(-122.79, 38.80, 4.3, originTime, source='eu')
+
+def test_late_arrival_keeps_arrival_order():
+	db = EventDB()
+	db.addEvents([quake('us%d' % index, 600 * index, 10.0 * index, 5.0, 3.0, 'usgs') for index in range(5)])
+	generation = db.layoutGeneration
+	# Published after us4, but happened before it
+	assert db.addEvents([quake('ak1', 1000, -150.0, 61.0, 2.5, 'usgs')]) == 1
+	assert db.layoutGeneration == generation
+	assert db.EQEventMeta[0][0] == 'ak1'
+	assert db.isNewestEvent('us4') and not db.isNewestEvent('ak1')
+
+	# A load of history is put in time order once
+	assert db.sortByTime()
+	assert [eventID for eventID, eventTime in db.EQEventMeta] == ['us4', 'us3', 'us2', 'ak1', 'us1', 'us0']
+	assert db.getEvent(3)[0] == -150.0
+
+def test_eviction_hands_the_marker_to_the_renderer():
+	db = EventDB(retention=RetentionPolicy(maxEvents=3, maxBytes=None))
+	db.addEvents([quake('us%d' % index, 60 * index, 10.0 * index, 5.0, 3.0 + index / 10, 'usgs') for index in range(4)])
+	generation = db.layoutGeneration
+	assert db.takeEvicted() == [(0.0, 5.0, 3.0)]
+	assert db.takeEvicted() == []
+
+	# Past the limit the renderer is told to start over instead
+	db.setRetention(None, 3 + EVICTED_MARKERS_MAX, None)
+	db.addEvents([quake('nc%d' % index, 600 + index, 0.1 * index, 0.0, 2.0, 'usgs')
+		for index in range(2 * EVICTED_MARKERS_MAX + 3)])
+	assert db.layoutGeneration > generation
+	assert len(db.takeEvicted()) < EVICTED_MARKERS_MAX
@@ -0,0 +1,121 @@
+from urllib.parse import urlparse, parse_qs
+from EQEventGatherer import EQEventGatherer
+from SourceRegistry import FeedSource
+import EQEventGatherer as gathererModule
+from EQEvent import millisToISO
+
+FEED_URL = 'http://feed.test/summary/all_hour.geojson'
+
+class FakeResponse:
+
+	def __init__(self, document):
+		self.document = document
+
+	def json(self):
+		return self.document
+
+def feature(eventID, eventTime, updated=None):
+	return {'type': 'Feature', 'id': eventID,
+		'properties': {'time': eventTime, 'updated': updated or eventTime, 'mag': 3.1, 'place': '10 km N of Town'},
+		'geometry': {'type': 'Point', 'coordinates': [-150.0, 61.0, 10.0]}}
+
+def poll(monkeypatch, gatherer, features):
+	monkeypatch.setattr(gathererModule.feedSession, 'get',
+		lambda url, timeout=10, stream=False: FakeResponse({'features': features}))
+	assert gatherer.requestNewEvents()
+	return [event.id for event in gatherer.getNewEvents()], [event.id for event in gatherer.getRevisedEvents()]
+
+def test_feed_late_arrival_with_older_origin_time_is_new(monkeypatch):
+	gatherer = EQEventGatherer(FeedSource('usgs', FEED_URL, kind='feed'))
+	newIDs, revisedIDs = poll(monkeypatch, gatherer, [feature('us2', 1700000600000), feature('us1', 1700000000000)])
+	assert newIDs == ['us1', 'us2']
+
+	# ak1 is published after us2 was read, but happened before it
+	newIDs, revisedIDs = poll(monkeypatch, gatherer,
+		[feature('us2', 1700000600000), feature('ak1', 1700000300000), feature('us1', 1700000000000)])
+	assert newIDs == ['ak1']
+	assert revisedIDs == []
+
+def test_feed_revision_and_unstored_event(monkeypatch):
+	stored = set()
+	gatherer = EQEventGatherer(FeedSource('usgs', FEED_URL, kind='feed'), isKnown=lambda eventID: eventID in stored)
+	poll(monkeypatch, gatherer, [feature('us1', 1700000000000)])
+	stored.add('us1')
+
+	newIDs, revisedIDs = poll(monkeypatch, gatherer, [feature('us1', 1700000000000, updated=1700000900000)])
+	assert newIDs == []
+	assert revisedIDs == ['us1']
+
+	# Listed before but never stored, offered again
+	newIDs, revisedIDs = poll(monkeypatch, gatherer, [feature('us1', 1700000000000, updated=1700000900000),
+		feature('us3', 1700000100000)])
+	newIDs, revisedIDs = poll(monkeypatch, gatherer, [feature('us1', 1700000000000, updated=1700000900000),
+		feature('us3', 1700000100000)])
+	assert newIDs == ['us3']
+
+def fdsnFeature(eventID, eventTime, updated=None, mag=3.0):
+	return {'type': 'Feature', 'id': eventID,
+		'properties': {'unid': eventID, 'time': millisToISO(eventTime), 'lastupdate': millisToISO(updated or eventTime),
+			'mag': mag, 'lon': 12.0, 'lat': 42.0, 'depth': 8.0, 'flynn_region': 'CENTRAL ITALY'}}
+
+# Stand-in FDSN service over a list of features, honouring updatedafter, offset, limit and orderby
+def serveFDSN(monkeypatch, features, urls):
+	def get(url, timeout=10, stream=False):
+		urls.append(url)
+		query = parse_qs(urlparse(url).query)
+		served = sorted(features, key=lambda feature: feature['properties']['time'],
+			reverse=query.get('orderby') != ['time-asc'])
+		if 'updatedafter' in query:
+			served = [feature for feature in served if feature['properties']['lastupdate'] > query['updatedafter'][0]]
+		served = served[int(query.get('offset', ['1'])[0]) - 1:][:int(query.get('limit', ['1000'])[0])]
+		return FakeResponse({'features': served})
+	monkeypatch.setattr(gathererModule.feedSession, 'get', get)
+
+def test_fdsn_event_published_late_is_fetched_by_update_time(monkeypatch):
+	urls = []
+	features = [fdsnFeature('eu2', 1700000600000)]
+	serveFDSN(monkeypatch, features, urls)
+	gatherer = EQEventGatherer(FeedSource('eu', 'http://fdsn.test/query', kind='fdsn'))
+	assert gatherer.requestNewEvents()
+	assert [event.id for event in gatherer.getNewEvents()] == ['eu2']
+
+	# eu1 happened well before eu2 but is only published now
+	features.append(fdsnFeature('eu1', 1700000000000, updated=1700001800000))
+	assert gatherer.requestNewEvents()
+	assert 'updatedafter=' + millisToISO(1700000600000) in urls[1]
+	assert [event.id for event in gatherer.getNewEvents()] == ['eu1']
+
+def test_fdsn_revision_of_stored_event(monkeypatch):
+	urls = []
+	stored = set()
+	features = [fdsnFeature('eu1', 1700000000000)]
+	serveFDSN(monkeypatch, features, urls)
+	gatherer = EQEventGatherer(FeedSource('eu', 'http://fdsn.test/query', kind='fdsn'),
+		isKnown=lambda eventID: eventID in stored)
+	gatherer.requestNewEvents()
+	stored.add('eu1')
+
+	features[0] = fdsnFeature('eu1', 1700000000000, updated=1700000900000, mag=3.4)
+	assert gatherer.requestNewEvents()
+	assert gatherer.getNewEvents() == []
+	assert [(event.id, event.mag) for event in gatherer.getRevisedEvents()] == [('eu1', 3.4)]
+
+	# Nothing changed since
+	assert gatherer.requestNewEvents()
+	assert gatherer.getNewEvents() == [] and gatherer.getRevisedEvents() == []
+
+def test_fdsn_delta_larger_than_a_page(monkeypatch):
+	urls = []
+	features = [fdsnFeature('eu0', 1700000000000)]
+	serveFDSN(monkeypatch, features, urls)
+	gatherer = EQEventGatherer(FeedSource('eu', 'http://fdsn.test/query', kind='fdsn', limit=2))
+	gatherer.requestNewEvents()
+
+	features.extend(fdsnFeature('eu%d' % index, 1700000000000 + index * 1000, updated=1700000100000 - index * 1000)
+		for index in range(1, 6))
+	seen = []
+	for poll in range(3):
+		assert gatherer.requestNewEvents()
+		seen.extend(event.id for event in gatherer.getNewEvents())
+	assert seen == ['eu1', 'eu2', 'eu3', 'eu4', 'eu5']
+	assert gatherer.cursorUpdated == 1700000099000
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+import glob
+import EventDB as eventDBModule
+from EventDB import EventDB
+from DayFile import DayFile
+from EQEvent import EQEvent
+
+def quakes(prefix, day, count):
+	start = datetime.combine(day, datetime.min.time()) + timedelta(hours=9)
+	return [EQEvent(prefix + str(index), int((start + timedelta(minutes=10 * index)).timestamp() * 1000),
+		10.0 * index - 100.0, 5.0 * index - 40.0, 10.0, 3.0 + index / 10.0, None, 0, 'Place ' + str(index), 'usgs')
+		for index in range(count)]
+
+def workIn(monkeypatch, tmp_path):
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(eventDBModule, 'RAMDISK_DIR', str(tmp_path / 'missing') + '/')
+
+def test_journal_replays_events_and_counts_them_once(monkeypatch, tmp_path):
+	workIn(monkeypatch, tmp_path)
+	today = datetime.now()
+	db = EventDB()
+	db.openJournal(today)
+	db.addEvents(quakes('us', today.date(), 5))
+	days = db.rollups.daySeries(1, today)
+
+	restarted = EventDB()
+	assert restarted.openJournal(today) == 5
+	assert [event for event in restarted.EQEventQueue] == [event for event in db.EQEventQueue]
+	assert restarted.rollups.daySeries(1, today) == days == [5]
+
+def test_rollups_catch_up_with_records_saved_after_them(monkeypatch, tmp_path):
+	workIn(monkeypatch, tmp_path)
+	today = datetime.now()
+	db = EventDB()
+	db.openJournal(today)
+	db.addEvents(quakes('us', today.date(), 3))
+	# Power cut after the journal write, before the rollups are saved
+	for event in quakes('nc', today.date(), 2):
+		db.addEvent(event.lon, event.lat + 1, event.mag, None, 0, event.place,
+			event_time=datetime.fromtimestamp(event.time / 1000), event_id=event.id, source='usgs')
+	db.journal.flush()
+
+	restarted = EventDB()
+	assert restarted.openJournal(today) == 5
+	assert restarted.rollups.daySeries(1, today) == [5]
+
+def test_earlier_day_journal_is_filed_and_removed(monkeypatch, tmp_path):
+	workIn(monkeypatch, tmp_path)
+	today = datetime.now()
+	yesterday = today - timedelta(days=1)
+	db = EventDB()
+	db.openJournal(yesterday)
+	db.addEvents(quakes('us', yesterday.date(), 4))
+	db.journal.close()
+
+	# Restart after midnight
+	restarted = EventDB()
+	assert restarted.recoverJournals(today) == 1
+	restarted.openJournal(today)
+	assert restarted.numberOfEvents() == 0
+	assert glob.glob("EQMjournal*.log") == []
+	with DayFile("EQMdatabase" + yesterday.strftime("%Y%m%d") + ".dat") as day:
+		assert len(day) == 4
+		assert sorted(eventID for eventID, eventTime in day.meta()) == ['us0', 'us1', 'us2', 'us3']
+	assert restarted.rollups.daySeries(1, yesterday) == [4]
+
+	# Nothing is left to recover or count twice
+	again = EventDB()
+	assert again.recoverJournals(today) == 0
+	again.rollups.load()
+	assert again.rollups.daySeries(1, yesterday) == [4]